@@ -0,0 +1,373 @@
+# async_client.py
+
+import asyncio
+import itertools
+import threading
+from protocol import Protocolo # Importamos nuestra clase de protocolo
+
+"""
+Este módulo ofrece un cliente programable para bots y puentes, sin `input()` ni `print`.
+Hace el saludo (`username_request`) por su cuenta, envía con escritura en lote
+(varios mensajes en una sola escritura al socket) y entrega los mensajes
+entrantes como un iterador asíncrono:
+
+    async with ClienteAsync("bot", host, port) as cliente:
+        await cliente.enviar("hola")
+        async for mensaje in cliente:
+            ...
+
+`PoolClientes` reparte muchos de estos clientes entre unos pocos hilos, cada uno
+con su propio bucle de eventos.
+"""
+
+class ClienteAsync:
+    """
+    Cliente de chat sobre asyncio.
+
+    `enviar` no espera a que el mensaje salga: lo añade al búfer de salida, que se
+    vacía en una sola escritura en la siguiente vuelta del bucle de eventos. Solo
+    espera (control de flujo) si el búfer supera `LIMITE_BUFER` bytes.
+    """
+
+    # Bytes pendientes de escribir a partir de los cuales `enviar` espera a que se vacíen.
+    LIMITE_BUFER = 256 * 1024
+    # Marca el final del iterador de mensajes cuando se pierde la conexión.
+    _FIN = object()
+    # `id` del latido con el que, sin sesión, se confirma el registro.
+    _ID_REGISTRO = "registro"
+
+    def __init__(self, nombre_usuario, host='127.0.0.1', port=55555, ruta_unix=None,
+                 compresion=True, reanudar=True, gracia_reconexion=30.0):
+        """
+        Args:
+            nombre_usuario (str): Nombre con el que se registra el cliente.
+            host (str): La dirección IP del servidor.
+            port (int): El puerto del servidor.
+            ruta_unix (str): Si se indica, se conecta por este socket Unix en lugar de por TCP.
+            compresion (bool): Si se acepta la compresión que ofrezca el servidor.
+            reanudar (bool): Si se pide una sesión reanudable para sobrevivir a cortes y reinicios.
+            gracia_reconexion (float): Segundos durante los que se intenta reconectar.
+        """
+        self.nombre_usuario = nombre_usuario
+        self.host = host
+        self.port = port
+        self.ruta_unix = ruta_unix
+        self.compresion = compresion
+        self.reanudar = reanudar
+        self.gracia_reconexion = gracia_reconexion
+        # Bucle de eventos en el que vive el cliente (se fija al conectar).
+        self.bucle = None
+        self.compresion_negociada = False
+        self.token_sesion = None
+        self.ultima_secuencia = 0
+        # Mensajes que el servidor rechazó por estar reiniciándose; se reenvían al reanudar.
+        self.pendientes_reenvio = []
+        self._reader = None
+        self._writer = None
+        self._activo = False
+        # Solo se escribe en el socket después de haber contestado al saludo.
+        self._saludado = False
+        self._pendiente = bytearray()
+        self._vaciado_programado = False
+        self._mensajes = None
+        self._registrado = None
+        self._tarea_lectura = None
+
+    async def conectar(self):
+        """
+        Abre la conexión y espera a que el servidor registre al cliente: con sesión,
+        hasta recibir 'session'; sin ella, hasta el 'pong' de un latido enviado tras el saludo,
+        que el servidor solo contesta una vez registrado.
+
+        Returns:
+            ClienteAsync: El propio cliente, ya registrado.
+
+        Raises:
+            ConnectionError: Si el servidor cierra la conexión sin registrarlo
+                (p. ej. por un nombre de usuario vacío).
+        """
+        self.bucle = asyncio.get_running_loop()
+        self._mensajes = asyncio.Queue()
+        self._registrado = asyncio.Event()
+        await self._abrir()
+        self._activo = True
+        self._tarea_lectura = asyncio.create_task(self._bucle_lectura())
+        await self._registrado.wait()
+        if not self._activo:
+            # `_bucle_lectura` activa `_registrado` también al salir, para no dejarnos esperando.
+            await self.cerrar()
+            raise ConnectionError("El servidor cerró la conexión sin registrar al cliente.")
+        return self
+
+    async def enviar(self, texto):
+        """
+        Envía un mensaje de chat.
+        """
+        await self.enviar_mensaje({"type": "message", "text": texto})
+
+    async def enviar_mensaje(self, mensaje):
+        """
+        Envía cualquier mensaje del protocolo. Vuelve en cuanto queda en el búfer de
+        salida, así que varios envíos seguidos viajan juntos sin esperar respuesta.
+        """
+        if not self._activo:
+            raise ConnectionError("El cliente no está conectado.")
+        self._escribir(self._trama(mensaje))
+
+        if self._saludado and len(self._pendiente) + self._writer.transport.get_write_buffer_size() > self.LIMITE_BUFER:
+            self._vaciar()
+            await self._writer.drain()
+
+    async def cerrar(self):
+        """
+        Se despide del servidor y cierra la conexión.
+        """
+        self._activo = False
+        if self._writer is not None:
+            try:
+                if self.token_sesion:
+                    # Sin despedida, el servidor guardaría la sesión esperando una reconexión.
+                    self._escribir(Protocolo.trama(Protocolo.codificar({"type": "leave"})))
+                self._vaciar()
+                self._writer.close()
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        if self._tarea_lectura is not None:
+            await asyncio.gather(self._tarea_lectura, return_exceptions=True)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        mensaje = await self._mensajes.get()
+        if mensaje is self._FIN:
+            # Lo dejamos en la cola para que cualquier otra iteración también termine.
+            self._mensajes.put_nowait(self._FIN)
+            raise StopAsyncIteration
+        return mensaje
+
+    async def __aenter__(self):
+        return await self.conectar()
+
+    async def __aexit__(self, *excepcion):
+        await self.cerrar()
+
+    async def _abrir(self):
+        """
+        Abre el socket (TCP o Unix) con el servidor.
+        """
+        self._saludado = False
+        if self.ruta_unix:
+            self._reader, self._writer = await asyncio.open_unix_connection(self.ruta_unix)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+    async def _recibir(self):
+        """
+        Lee una trama completa y devuelve el mensaje, o None si la conexión se cierra.
+        Como `Protocolo.recibir_payload`, rechaza las tramas demasiado grandes y las
+        comprimidas si no se negoció la compresión.
+        """
+        try:
+            tamaño, comprimido = Protocolo.leer_cabecera(await self._reader.readexactly(4))
+            if tamaño > Protocolo.MAXIMO_TRAMA or (comprimido and not self.compresion_negociada):
+                return None
+            payload = await self._reader.readexactly(tamaño)
+        except (asyncio.IncompleteReadError, OSError):
+            return None
+        if comprimido:
+            try:
+                payload = Protocolo.descomprimir(payload, Protocolo.MAXIMO_TRAMA)
+            except ValueError:
+                return None
+        return Protocolo.decodificar(payload)
+
+    async def _bucle_lectura(self):
+        """
+        Tarea que lee del servidor: contesta al saludo, guarda el token de sesión
+        y deja el resto de mensajes en la cola del iterador.
+        """
+        while True:
+            mensaje = await self._recibir()
+            if mensaje is None or mensaje.get("type") == "reconnect":
+                # Con sesión, un corte o un reinicio del servidor se superan reconectando.
+                if self._activo and self.token_sesion and await self._reconectar():
+                    continue
+                break
+
+            # Apuntamos el último mensaje numerado para pedir solo lo que nos falte. El `seq`
+            # de 'session' es el último del servidor, no el último que hemos recibido.
+            if mensaje.get("type") in Protocolo.TIPOS_DIFUNDIDOS and isinstance(mensaje.get("seq"), int):
+                self.ultima_secuencia = mensaje["seq"]
+
+            tipo_mensaje = mensaje.get("type")
+            if tipo_mensaje == "username_request":
+                self._responder_saludo(mensaje)
+            elif tipo_mensaje == "session":
+                if not mensaje.get("resumed") and isinstance(mensaje.get("seq"), int):
+                    # Sesión nueva: lo anterior a su creación no nos corresponde.
+                    self.ultima_secuencia = mensaje["seq"]
+                self.token_sesion = mensaje.get("resume_token")
+                for pendiente in self.pendientes_reenvio:
+                    self._escribir(self._trama(pendiente))
+                self.pendientes_reenvio.clear()
+                self._registrado.set()
+            elif tipo_mensaje == "pong" and mensaje.get("id") == self._ID_REGISTRO and not self._registrado.is_set():
+                self._registrado.set()
+            elif tipo_mensaje == "rejected" and self.token_sesion and isinstance(mensaje.get("message"), dict):
+                # El servidor se estaba reiniciando y no lo difundió: lo reenviamos al reanudar.
+                self.pendientes_reenvio.append(mensaje["message"])
+            else:
+                self._mensajes.put_nowait(mensaje)
+
+        self._activo = False
+        # Si el servidor nos rechaza antes de registrarnos, `conectar` no debe quedarse esperando.
+        self._registrado.set()
+        self._mensajes.put_nowait(self._FIN)
+
+    def _responder_saludo(self, solicitud):
+        """
+        Contesta al `username_request` antes que a cualquier mensaje que ya estuviera
+        en el búfer, negociando la compresión y, si procede, la reanudación.
+        """
+        respuesta = {"username": self.nombre_usuario}
+        codecs = [c for c in solicitud.get("compression", []) if c in Protocolo.CODECS]
+        if self.compresion and codecs:
+            respuesta["compression"] = codecs[0]
+        self.compresion_negociada = self.compresion and bool(codecs)
+        if self.reanudar:
+            respuesta["resume"] = True
+            if self.token_sesion:
+                respuesta["resume_token"] = self.token_sesion
+                respuesta["last_seq"] = self.ultima_secuencia
+        self._writer.write(Protocolo.trama(Protocolo.codificar(respuesta)))
+        self._saludado = True
+        self._vaciar()
+        if not self.reanudar:
+            # Sin sesión no llega 'session': el 'pong' de este latido confirma el registro.
+            self._writer.write(self._trama({"type": "ping", "id": self._ID_REGISTRO}))
+
+    async def _reconectar(self):
+        """
+        Intenta volver a conectar durante el plazo de gracia.
+
+        Returns:
+            bool: True si se ha vuelto a conectar.
+        """
+        self._writer.close()
+        limite = self.bucle.time() + self.gracia_reconexion
+        espera = 0.1
+        while self._activo and self.bucle.time() < limite:
+            try:
+                await self._abrir()
+                return True
+            except OSError:
+                await asyncio.sleep(espera)
+                espera = min(espera * 2, 2.0)
+        return False
+
+    def _trama(self, mensaje):
+        """
+        Empaqueta un mensaje, comprimido si se negoció y merece la pena.
+        """
+        payload = Protocolo.codificar(mensaje)
+        trama = None
+        if self.compresion_negociada and len(payload) > Protocolo.UMBRAL_COMPRESION:
+            trama = Protocolo.trama_comprimida(payload)
+        return trama or Protocolo.trama(payload)
+
+    def _escribir(self, trama):
+        """
+        Añade una trama al búfer de salida y programa su vaciado para la siguiente
+        vuelta del bucle, de modo que todo lo enviado hasta entonces se escribe de una vez.
+        """
+        self._pendiente += trama
+        if not self._vaciado_programado:
+            self._vaciado_programado = True
+            self.bucle.call_soon(self._vaciar)
+
+    def _vaciar(self):
+        """
+        Escribe en el socket todo lo acumulado en el búfer de salida.
+        """
+        self._vaciado_programado = False
+        if self._pendiente and self._saludado and not self._writer.is_closing():
+            self._writer.write(bytes(self._pendiente))
+            self._pendiente.clear()
+
+
+class PoolClientes:
+    """
+    Reparte muchos clientes (identidades de bots) entre unos pocos hilos, cada uno
+    con su propio bucle de eventos. Un cliente vive siempre en el bucle en el que
+    se conectó, así que sus corrutinas deben lanzarse en ese mismo bucle.
+
+        with PoolClientes(hilos=4) as pool:
+            cliente = pool.lanzar(ClienteAsync("bot1", host, port).conectar()).result()
+            pool.lanzar(cliente.enviar("hola"), cliente=cliente).result()
+    """
+
+    def __init__(self, hilos=2):
+        """
+        Args:
+            hilos (int): Número de hilos (y bucles de eventos) del pool.
+        """
+        self.bucles = [asyncio.new_event_loop() for _ in range(hilos)]
+        self._hilos = [threading.Thread(target=bucle.run_forever, daemon=True) for bucle in self.bucles]
+        # Reparto por turnos de las corrutinas que no están atadas a un cliente.
+        self._turno = itertools.cycle(self.bucles)
+        self._lock = threading.Lock()
+
+    def iniciar(self):
+        """
+        Arranca los hilos del pool.
+        """
+        for hilo in self._hilos:
+            hilo.start()
+
+    def lanzar(self, corrutina, cliente=None):
+        """
+        Ejecuta una corrutina en uno de los bucles del pool.
+
+        Args:
+            corrutina: La corrutina a ejecutar.
+            cliente (ClienteAsync): Si se indica, se ejecuta en el bucle de ese cliente.
+
+        Returns:
+            concurrent.futures.Future: Permite esperar el resultado desde cualquier hilo.
+        """
+        if cliente is not None:
+            bucle = cliente.bucle
+        else:
+            with self._lock:
+                bucle = next(self._turno)
+        return asyncio.run_coroutine_threadsafe(corrutina, bucle)
+
+    def detener(self):
+        """
+        Cancela lo que quede pendiente en cada bucle y detiene los hilos.
+        """
+        for bucle in self.bucles:
+            if bucle.is_running():
+                asyncio.run_coroutine_threadsafe(self._cancelar_tareas(), bucle).result()
+                bucle.call_soon_threadsafe(bucle.stop)
+        for hilo in self._hilos:
+            if hilo.is_alive():
+                hilo.join()
+        for bucle in self.bucles:
+            bucle.close()
+
+    @staticmethod
+    async def _cancelar_tareas():
+        tareas = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+
+    def __enter__(self):
+        self.iniciar()
+        return self
+
+    def __exit__(self, *excepcion):
+        self.detener()
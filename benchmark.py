@@ -0,0 +1,295 @@
+# benchmark.py
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from server import Servidor
+from protocol import Protocolo
+from async_client import ClienteAsync, PoolClientes
+
+"""
+Pruebas de carga del servidor de chat. Cada escenario levanta sus propios
+servidores en este proceso, los somete a carga y muestra un pequeño informe.
+
+Uso:
+    python benchmark.py reinicio [--modo traspaso|corte] [--clientes N] [--segundos S] [--arranque A]
+    python benchmark.py transportes [--mensajes N]
+    python benchmark.py carga [--bots N] [--mensajes M] [--hilos H]
+"""
+
+def _ida_y_vuelta(host, port):
+    """
+    Abre una conexión, completa el saludo y espera la respuesta a un 'stats'.
+
+    Returns:
+        str: "ok", "reconnect" si el servidor pidió reconectar, o "error".
+    """
+    try:
+        with socket.create_connection((host, port), timeout=2) as sock:
+            if (Protocolo.recibir(sock) or {}).get("type") != "username_request":
+                return "error"
+            Protocolo.enviar(sock, {"username": "bench"})
+            Protocolo.enviar(sock, {"type": "stats"})
+            while True:
+                mensaje = Protocolo.recibir(sock)
+                if mensaje is None:
+                    return "error"
+                if mensaje.get("type") == "stats":
+                    return "ok"
+                if mensaje.get("type") == "reconnect":
+                    return "reconnect"
+    except OSError:
+        return "error"
+
+
+def escenario_reinicio(modo, clientes, segundos, arranque):
+    """
+    Mide la tasa de errores de conexión mientras el servidor se reinicia bajo carga.
+
+    Args:
+        modo (str): "traspaso" hereda el socket de escucha por un socket Unix;
+            "corte" detiene el servidor y arranca otro en el mismo puerto.
+        clientes (int): Hilos que abren conexiones sin parar.
+        segundos (float): Duración total; el reinicio ocurre a la mitad.
+        arranque (float): Segundos que tarda en arrancar el proceso nuevo. Con traspaso
+            el servidor anterior sigue atendiendo mientras tanto; con corte no hay nadie.
+    """
+    ruta = os.path.join(tempfile.mkdtemp(), "traspaso.sock")
+    anterior = Servidor('127.0.0.1', 0, ruta_traspaso=ruta if modo == "traspaso" else None, plazo_drenaje=2.0)
+    anterior.iniciar()
+    host, port = anterior.direccion
+
+    resultados = {"ok": 0, "reconnect": 0, "error": 0}
+    lock = threading.Lock()
+    parar = threading.Event()
+
+    def generar_carga():
+        while not parar.is_set():
+            resultado = _ida_y_vuelta(host, port)
+            # Un aviso 'reconnect' no es un error: un cliente real reintenta en el servidor nuevo.
+            if resultado == "reconnect":
+                resultado = _ida_y_vuelta(host, port)
+                with lock:
+                    resultados["reconnect"] += 1
+            with lock:
+                resultados[resultado if resultado != "reconnect" else "error"] += 1
+
+    hilos = [threading.Thread(target=generar_carga, daemon=True) for _ in range(clientes)]
+    for hilo in hilos:
+        hilo.start()
+
+    time.sleep(segundos / 2)
+    inicio_reinicio = time.perf_counter()
+    # El reinicio incluye el arranque del proceso nuevo.
+    if modo == "traspaso":
+        time.sleep(arranque)
+        nuevo = Servidor('127.0.0.1', 0)
+        nuevo.iniciar(heredar_de=ruta)
+        # El servidor anterior se retira solo, tras drenar sus colas.
+        anterior.hilo_traspaso.join()
+    else:
+        anterior.detener()
+        time.sleep(arranque)
+        nuevo = Servidor('127.0.0.1', port)
+        nuevo.iniciar()
+    duracion_reinicio = time.perf_counter() - inicio_reinicio
+    time.sleep(segundos / 2)
+
+    parar.set()
+    for hilo in hilos:
+        hilo.join()
+    nuevo.detener()
+
+    total = resultados["ok"] + resultados["error"]
+    print(f"Escenario: reinicio ({modo}), {clientes} clientes, {segundos} s")
+    print(f"  Conexiones completadas: {resultados['ok']}")
+    print(f"  Conexiones fallidas:    {resultados['error']}")
+    print(f"  Avisos 'reconnect':     {resultados['reconnect']}")
+    print(f"  Tasa de error:          {100 * resultados['error'] / max(total, 1):.3f} %")
+    print(f"  Duración del reinicio:  {duracion_reinicio * 1000:.1f} ms")
+    return resultados
+
+
+def _abrir(servidor, transporte, nombre):
+    """
+    Conecta un cliente por el transporte indicado y espera a que quede registrado.
+
+    Args:
+        transporte (str): "tcp" (loopback), "unix" (socket Unix) o "local" (socketpair).
+    """
+    if transporte == "tcp":
+        sock = socket.create_connection(servidor.direccion)
+    elif transporte == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(servidor.ruta_unix)
+    else:
+        sock = servidor.conectar_local()
+    Protocolo.recibir(sock)
+    Protocolo.enviar(sock, {"username": nombre})
+    Protocolo.enviar(sock, {"type": "stats"})
+    while Protocolo.recibir(sock).get("type") != "stats":
+        pass
+    return sock
+
+
+def _recibir_texto(sock):
+    """
+    Devuelve el siguiente mensaje de chat, saltándose avisos como 'join' o 'leave'.
+    """
+    while True:
+        mensaje = Protocolo.recibir(sock)
+        if mensaje.get("type") == "message":
+            return mensaje
+
+
+def escenario_transportes(mensajes):
+    """
+    Compara la latencia y el caudal de un mensaje de chat (emisor -> servidor -> receptor)
+    sobre TCP loopback, socket Unix y socketpair dentro del mismo proceso.
+
+    Args:
+        mensajes (int): Mensajes por medición.
+    """
+    servidor = Servidor('127.0.0.1', 0, ruta_unix=os.path.join(tempfile.mkdtemp(), "chat.sock"))
+    servidor.iniciar()
+
+    resultados = {}
+    for transporte in ("tcp", "unix", "local"):
+        emisor = _abrir(servidor, transporte, "emisor")
+        receptor = _abrir(servidor, transporte, "receptor")
+
+        # Latencia: un mensaje cada vez, esperando a que llegue antes de enviar el siguiente.
+        latencias = []
+        for i in range(mensajes):
+            inicio = time.perf_counter()
+            Protocolo.enviar(emisor, {"type": "message", "text": f"ping {i}"})
+            _recibir_texto(receptor)
+            latencias.append(time.perf_counter() - inicio)
+        latencias.sort()
+
+        # Caudal: todos los mensajes seguidos mientras otro hilo los va leyendo.
+        lector = threading.Thread(target=lambda: [_recibir_texto(receptor) for _ in range(mensajes)])
+        inicio = time.perf_counter()
+        lector.start()
+        for i in range(mensajes):
+            Protocolo.enviar(emisor, {"type": "message", "text": f"carga {i}"})
+        lector.join()
+        caudal = mensajes / (time.perf_counter() - inicio)
+
+        resultados[transporte] = {
+            "p50": latencias[len(latencias) // 2],
+            "p99": latencias[min(len(latencias) - 1, int(len(latencias) * 0.99))],
+            "caudal": caudal
+        }
+        emisor.close()
+        receptor.close()
+    servidor.detener()
+
+    base = resultados["tcp"]
+    print(f"Escenario: transportes, {mensajes} mensajes por medición")
+    print(f"  {'transporte':<10} {'p50 (us)':>10} {'p99 (us)':>10} {'mensajes/s':>12} {'vs tcp':>8}")
+    for transporte, r in resultados.items():
+        print(f"  {transporte:<10} {r['p50'] * 1e6:>10.1f} {r['p99'] * 1e6:>10.1f} "
+              f"{r['caudal']:>12.0f} {r['caudal'] / base['caudal']:>7.2f}x")
+    return resultados
+
+
+async def _bot(cliente, mensajes, esperados, plazo):
+    """
+    Envía `mensajes` mensajes seguidos, sin esperar respuesta, y cuenta los que recibe
+    de los demás bots hasta llegar a `esperados` o agotar el plazo.
+
+    Returns:
+        int: Mensajes de chat recibidos.
+    """
+    for i in range(mensajes):
+        await cliente.enviar(f"{cliente.nombre_usuario} {i}")
+    recibidos = 0
+
+    async def contar():
+        nonlocal recibidos
+        async for mensaje in cliente:
+            if mensaje.get("type") == "message":
+                recibidos += 1
+                if recibidos == esperados:
+                    return
+
+    try:
+        await asyncio.wait_for(contar(), plazo)
+    except asyncio.TimeoutError:
+        pass
+    return recibidos
+
+
+def escenario_carga(bots, mensajes, hilos):
+    """
+    Conecta muchos bots con el cliente asíncrono, repartidos entre unos pocos hilos,
+    y hace que todos envíen a la vez. Cada mensaje llega a todos los demás bots.
+
+    Args:
+        bots (int): Número de bots conectados.
+        mensajes (int): Mensajes que envía cada bot.
+        hilos (int): Hilos (bucles de eventos) entre los que se reparten los bots.
+    """
+    servidor = Servidor('127.0.0.1', 0)
+    servidor.iniciar()
+    host, port = servidor.direccion
+    esperados = mensajes * (bots - 1)
+
+    with PoolClientes(hilos) as pool:
+        inicio = time.perf_counter()
+        # Sin sesión reanudable: al terminar no queremos que el servidor guarde a nadie.
+        futuros = [pool.lanzar(ClienteAsync(f"bot{i}", host, port, reanudar=False).conectar())
+                   for i in range(bots)]
+        clientes = [f.result() for f in futuros]
+        duracion_conexion = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        futuros = [pool.lanzar(_bot(c, mensajes, esperados, plazo=30.0), cliente=c) for c in clientes]
+        recibidos = sum(f.result() for f in futuros)
+        duracion = time.perf_counter() - inicio
+
+        for c in clientes:
+            pool.lanzar(c.cerrar(), cliente=c).result()
+    servidor.detener()
+
+    print(f"Escenario: carga, {bots} bots en {hilos} hilos, {mensajes} mensajes por bot")
+    print(f"  Conexión de todos los bots: {duracion_conexion * 1000:.1f} ms")
+    print(f"  Entregas:                   {recibidos} de {esperados * bots}")
+    print(f"  Entregas por segundo:       {recibidos / duracion:.0f}")
+    return recibidos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pruebas de carga del servidor de chat.")
+    escenarios = parser.add_subparsers(dest="escenario", required=True)
+
+    reinicio = escenarios.add_parser("reinicio", help="Errores de conexión durante un reinicio.")
+    reinicio.add_argument("--modo", choices=("traspaso", "corte"), default="traspaso")
+    reinicio.add_argument("--clientes", type=int, default=16)
+    reinicio.add_argument("--segundos", type=float, default=4.0)
+    reinicio.add_argument("--arranque", type=float, default=0.3)
+
+    transportes = escenarios.add_parser("transportes", help="Latencia y caudal por TCP, Unix y socketpair.")
+    transportes.add_argument("--mensajes", type=int, default=2000)
+
+    carga = escenarios.add_parser("carga", help="Muchos bots asíncronos enviando a la vez.")
+    carga.add_argument("--bots", type=int, default=50)
+    carga.add_argument("--mensajes", type=int, default=20)
+    carga.add_argument("--hilos", type=int, default=2)
+
+    argumentos = parser.parse_args()
+    # Los logs de cada conexión taparían el informe.
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    if argumentos.escenario == "reinicio":
+        escenario_reinicio(argumentos.modo, argumentos.clientes, argumentos.segundos, argumentos.arranque)
+    elif argumentos.escenario == "transportes":
+        escenario_transportes(argumentos.mensajes)
+    elif argumentos.escenario == "carga":
+        escenario_carga(argumentos.bots, argumentos.mensajes, argumentos.hilos)
@@ -1,26 +1,62 @@
 # client.py
 
+import os
+import base64
 import socket
 import threading
 import logging
+import time
+import uuid
 from protocol import Protocolo # Importamos nuestra clase de protocolo
 
 # Configuración básica de logging.
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class Cliente:
-    def __init__(self, host='127.0.0.1', port=55555):
+    # Segundos que un envío de archivo espera crédito del servidor antes de abandonar.
+    PLAZO_CREDITO = 30.0
+    # Segundos entre comprobaciones de `activo` mientras un envío espera al saludo.
+    INTERVALO_SALUDO = 0.2
+
+    def __init__(self, host='127.0.0.1', port=55555, directorio_descargas='descargas',
+                 gracia_reconexion=30.0, ruta_unix=None):
         """
         Inicializa el cliente.
         
         Args:
             host (str): La dirección IP del servidor al que se conectará.
             port (int): El puerto del servidor.
+            directorio_descargas (str): Carpeta donde se guardan los archivos recibidos.
+            gracia_reconexion (float): Segundos durante los que se intenta reconectar y
+                reanudar la sesión si se pierde la conexión.
+            ruta_unix (str): Si se indica, se conecta por este socket Unix en lugar de
+                por TCP (para clientes en la misma máquina que el servidor).
         """
         self.host = host
         self.port = port
+        self.ruta_unix = ruta_unix
         self.socket_cliente = None
         self.nombre_usuario = ""
+        # Se activa si el servidor ofrece un códec de compresión que conocemos.
+        self.compresion = False
+        # El hilo de entrada y los hilos que envían archivos comparten el socket;
+        # este Lock evita que se mezclen los bytes de dos tramas.
+        self.lock_envio = threading.Lock()
+        # Se activa al contestar el `username_request` de la conexión en uso. Hasta entonces
+        # no se envía nada más: el servidor tomaría esa trama por la respuesta al saludo.
+        self.saludado = threading.Event()
+        self.directorio_descargas = directorio_descargas
+        # Archivos que estamos recibiendo. {id: (archivo, ruta)}
+        self.descargas = {}
+        # Fragmentos que el servidor nos deja enviar de cada archivo que enviamos. {id: fragmentos}
+        self.creditos = {}
+        self.cambio_creditos = threading.Condition()
+        # Datos para reanudar la sesión tras un corte: token y último mensaje recibido.
+        self.gracia_reconexion = gracia_reconexion
+        self.token_sesion = None
+        self.ultima_secuencia = 0
+        # Mensajes que el servidor rechazó por estar reiniciándose; se reenvían al reanudar.
+        self.pendientes_reenvio = []
         # Variable para controlar los bucles de los hilos.
         self.activo = True
 
@@ -32,8 +68,7 @@ class Cliente:
         
         try:
             # Crea el socket y se conecta al servidor.
-            self.socket_cliente = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket_cliente.connect((self.host, self.port))
+            self._conectar()
             logging.info("Conectado al servidor.")
             
             # Inicia un hilo para recibir mensajes del servidor.
@@ -52,6 +87,46 @@ class Cliente:
                 self.socket_cliente.close()
             logging.info("Desconectado.")
 
+    def _conectar(self):
+        """
+        Abre una conexión nueva con el servidor y la pone en uso.
+        """
+        if self.ruta_unix:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            direccion = self.ruta_unix
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            direccion = (self.host, self.port)
+        try:
+            sock.connect(direccion)
+        except OSError:
+            sock.close()
+            raise
+        with self.lock_envio:
+            anterior, self.socket_cliente = self.socket_cliente, sock
+            self.saludado.clear()
+        if anterior:
+            anterior.close()
+
+    def _reconectar(self):
+        """
+        Intenta volver a conectar durante el plazo de gracia. El saludo que sigue
+        (`username_request`) envía el token de sesión para reanudarla.
+
+        Returns:
+            bool: True si se ha vuelto a conectar.
+        """
+        limite = time.monotonic() + self.gracia_reconexion
+        espera = 0.1
+        while self.activo and time.monotonic() < limite:
+            try:
+                self._conectar()
+                return True
+            except OSError:
+                time.sleep(espera)
+                espera = min(espera * 2, 2.0)
+        return False
+
     def _bucle_recibir(self):
         """
         Bucle que se ejecuta en un hilo para recibir y procesar mensajes del servidor.
@@ -60,16 +135,63 @@ class Cliente:
             try:
                 mensaje = Protocolo.recibir(self.socket_cliente)
                 if not mensaje:
+                    # Si tenemos sesión, intentamos reanudarla antes de rendirnos.
+                    if self.activo and self.token_sesion and self._reconectar():
+                        continue
                     # Si no hay mensaje, el servidor cerró la conexión.
                     print(">>> El servidor se ha desconectado.")
                     break
+
+                # Apuntamos el último mensaje numerado para pedir solo lo que nos falte. El `seq`
+                # de 'session' es el último del servidor, no el último que hemos recibido.
+                if mensaje.get("type") in Protocolo.TIPOS_DIFUNDIDOS and isinstance(mensaje.get("seq"), int):
+                    self.ultima_secuencia = mensaje["seq"]
                 
                 # Procesamos el mensaje según su tipo.
                 tipo_mensaje = mensaje.get("type")
                 
                 if tipo_mensaje == "username_request":
                     # El servidor pide nuestro nombre de usuario.
-                    Protocolo.enviar(self.socket_cliente, {"username": self.nombre_usuario})
+                    respuesta = {"username": self.nombre_usuario, "resume": True}
+                    if self.token_sesion:
+                        # Es una reconexión: pedimos reanudar la sesión y los mensajes perdidos.
+                        respuesta["resume_token"] = self.token_sesion
+                        respuesta["last_seq"] = self.ultima_secuencia
+                    # Si ofrece compresión, aceptamos el primer códec que conozcamos.
+                    codecs = [c for c in mensaje.get("compression", []) if c in Protocolo.CODECS]
+                    if codecs:
+                        respuesta["compression"] = codecs[0]
+                    self._enviar(respuesta, saludo=True)
+                    self.compresion = bool(codecs)
+                    # Ya pueden salir los mensajes que estaban esperando al saludo.
+                    self.saludado.set()
+
+                elif tipo_mensaje == "reconnect":
+                    # El servidor se está reiniciando: nos pasamos ya a la conexión nueva.
+                    if self.token_sesion and self._reconectar():
+                        continue
+                    print(">>> El servidor se ha desconectado.")
+                    break
+
+                elif tipo_mensaje == "session":
+                    if mensaje.get("resumed"):
+                        print(">>> Conexión recuperada.")
+                        if mensaje.get("gap"):
+                            print(">>> Algunos mensajes se han perdido durante el corte.")
+                    elif isinstance(mensaje.get("seq"), int):
+                        # Sesión nueva: lo anterior a su creación no nos corresponde.
+                        self.ultima_secuencia = mensaje["seq"]
+                    self.token_sesion = mensaje.get("resume_token")
+                    for pendiente in self.pendientes_reenvio:
+                        self._enviar(pendiente)
+                    self.pendientes_reenvio.clear()
+
+                elif tipo_mensaje == "rejected":
+                    # El servidor se estaba reiniciando y no lo difundió.
+                    if self.token_sesion and isinstance(mensaje.get("message"), dict):
+                        self.pendientes_reenvio.append(mensaje["message"])
+                    else:
+                        print(">>> Un mensaje no se ha entregado: el servidor se está reiniciando.")
                 
                 elif tipo_mensaje == "message":
                     print(f"{mensaje.get('username')}: {mensaje.get('text')}")
@@ -80,6 +202,15 @@ class Cliente:
                 elif tipo_mensaje == "leave":
                     print(f">>> {mensaje.get('username')} ha abandonado el chat.")
 
+                elif tipo_mensaje == "transfer_credit":
+                    with self.cambio_creditos:
+                        if mensaje.get("id") in self.creditos and isinstance(mensaje.get("chunks"), int):
+                            self.creditos[mensaje["id"]] += mensaje["chunks"]
+                            self.cambio_creditos.notify_all()
+
+                elif tipo_mensaje in Protocolo.TIPOS_TRANSFERENCIA:
+                    self._recibir_transferencia(mensaje)
+
             except Exception as e:
                 # Si el cliente sigue activo, mostramos el error. Si no, es normal que falle al cerrar.
                 if self.activo:
@@ -96,19 +227,142 @@ class Cliente:
         while self.activo:
             try:
                 texto = input()
-                if texto.strip() and self.activo:
+                if texto.startswith("/enviar ") and self.activo:
+                    # El archivo se envía en otro hilo para poder seguir chateando mientras tanto.
+                    ruta = texto[len("/enviar "):].strip()
+                    threading.Thread(target=self._enviar_archivo, args=(ruta,), daemon=True).start()
+                elif texto.strip() and self.activo:
                     # Si el usuario escribe algo, lo enviamos como un mensaje.
-                    Protocolo.enviar(self.socket_cliente, {
+                    self._enviar({
                         "type": "message",
                         "text": texto
                     })
             except (EOFError, KeyboardInterrupt):
                 # El usuario presionó Ctrl+D o Ctrl+C para salir.
                 print("\nCerrando cliente...")
+                # Nos despedimos para que el servidor no guarde la sesión esperando una reconexión.
+                try:
+                    self._enviar({"type": "leave"})
+                except Exception:
+                    pass
                 break
+            except OSError as e:
+                # Si estamos reconectando, el mensaje se pierde pero el cliente sigue.
+                logging.error(f"Error al enviar mensaje: {e}")
+                if not self.token_sesion:
+                    break
             except Exception as e:
                 logging.error(f"Error al enviar mensaje: {e}")
                 break
         
         # Si salimos del bule, detenemos al cliente.
-        self.activo = False
\ No newline at end of file
+        self.activo = False
+
+    def _enviar(self, data, saludo=False):
+        """
+        Envía un mensaje al servidor. Cada trama se escribe entera antes de la siguiente.
+        Salvo la respuesta al saludo, espera a que la conexión en uso esté saludada, así
+        que lo que se escribe durante una reconexión sale por la conexión nueva.
+
+        Raises:
+            ConnectionError: Si el cliente se detiene mientras espera.
+        """
+        while True:
+            with self.lock_envio:
+                if saludo or self.saludado.is_set():
+                    # El saludo siempre va plano: la compresión aún no está negociada.
+                    Protocolo.enviar(self.socket_cliente, data, compresion=self.compresion and not saludo)
+                    return
+            if not self.activo:
+                raise ConnectionError("El cliente se ha detenido antes de poder enviar.")
+            self.saludado.wait(self.INTERVALO_SALUDO)
+
+    def _enviar_archivo(self, ruta):
+        """
+        Envía un archivo como una transferencia por fragmentos. Entre fragmento y fragmento
+        se libera el socket, así que los mensajes de chat se intercalan sin esperar.
+        Cada fragmento gasta un crédito (`transfer_credit`); sin crédito se espera a que
+        el servidor lo devuelva, así que el envío va al ritmo del destinatario más lento.
+        """
+        id_transferencia = uuid.uuid4().hex
+        with self.cambio_creditos:
+            self.creditos[id_transferencia] = 0
+        try:
+            with open(ruta, 'rb') as archivo:
+                tamaño = os.fstat(archivo.fileno()).st_size
+                nombre = os.path.basename(ruta)
+                for mensaje in Protocolo.mensajes_transferencia(id_transferencia, nombre, archivo, tamaño):
+                    if mensaje["type"] == "transfer_chunk" and not self._gastar_credito(id_transferencia):
+                        if not self.activo:
+                            return
+                        if id_transferencia in self.creditos:
+                            # El servidor no nos ha devuelto crédito a tiempo: lo cancelamos nosotros.
+                            self._enviar({"type": "transfer_abort", "id": id_transferencia})
+                        print(f">>> El envío de {nombre} se ha cancelado.")
+                        return
+                    if not self.activo:
+                        return
+                    self._enviar(mensaje)
+            print(f">>> Archivo {nombre} enviado.")
+        except OSError as e:
+            logging.error(f"No se pudo enviar el archivo {ruta}: {e}")
+        finally:
+            with self.cambio_creditos:
+                self.creditos.pop(id_transferencia, None)
+
+    def _gastar_credito(self, id_transferencia):
+        """
+        Espera a tener crédito para un fragmento más y lo gasta.
+
+        Returns:
+            bool: False si el servidor canceló el envío, el cliente se detuvo o se agotó el plazo.
+        """
+        with self.cambio_creditos:
+            hay_credito = self.cambio_creditos.wait_for(
+                lambda: not self.activo or self.creditos.get(id_transferencia, 1) > 0,
+                self.PLAZO_CREDITO
+            )
+            if not hay_credito or not self.activo or id_transferencia not in self.creditos:
+                return False
+            self.creditos[id_transferencia] -= 1
+            return True
+
+    def _recibir_transferencia(self, mensaje):
+        """
+        Escribe en disco, fragmento a fragmento, los archivos que envían otros usuarios.
+        """
+        tipo_mensaje = mensaje.get("type")
+        id_transferencia = mensaje.get("id")
+
+        if tipo_mensaje == "transfer_abort":
+            # Puede ser el servidor cancelando un envío nuestro (p. ej. por exceder el límite).
+            with self.cambio_creditos:
+                if self.creditos.pop(id_transferencia, None) is not None:
+                    self.cambio_creditos.notify_all()
+                    return
+
+        if tipo_mensaje == "transfer_start":
+            os.makedirs(self.directorio_descargas, exist_ok=True)
+            # Nunca confiamos en la ruta que manda el otro extremo, solo en el nombre base.
+            nombre = os.path.basename(mensaje.get("name") or id_transferencia)
+            ruta = os.path.join(self.directorio_descargas, f"{id_transferencia[:8]}_{nombre}")
+            self.descargas[id_transferencia] = (open(ruta, 'wb'), ruta)
+            print(f">>> {mensaje.get('username')} está enviando {nombre} ({mensaje.get('size')} bytes).")
+            return
+
+        descarga = self.descargas.get(id_transferencia)
+        if not descarga:
+            return
+        archivo, ruta = descarga
+
+        if tipo_mensaje == "transfer_chunk":
+            archivo.write(base64.b64decode(mensaje.get("data", "")))
+        elif tipo_mensaje == "transfer_end":
+            archivo.close()
+            del self.descargas[id_transferencia]
+            print(f">>> Archivo recibido: {ruta}")
+        elif tipo_mensaje == "transfer_abort":
+            archivo.close()
+            os.remove(ruta)
+            del self.descargas[id_transferencia]
+            print(">>> La transferencia se ha cancelado.")
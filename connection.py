@@ -0,0 +1,283 @@
+# connection.py
+
+import socket
+import threading
+import logging
+import time
+from collections import deque
+
+"""
+Este módulo define la conexión de salida de cada cliente del servidor.
+En lugar de escribir en el socket desde el hilo que difunde un mensaje,
+las tramas se encolan y un hilo escritor propio de la conexión las envía.
+Así un cliente lento no bloquea a los demás.
+"""
+
+class Conexion:
+    """
+    Cola de salida de un cliente con su propio hilo escritor.
+
+    Las tramas se reparten en carriles. El de control (saludo, sesión, 'stats',
+    'pong') sale siempre primero, así que nunca espera detrás de una ráfaga.
+    Los de chat y transferencias se turnan por "deficit round robin": en cada
+    vuelta, cada carril puede enviar hasta `CUANTO * peso` bytes, de modo que
+    con los dos llenos se reparten el ancho de banda según sus pesos.
+    Dentro de un carril el orden se respeta siempre.
+
+    Las tramas de una transferencia se contabilizan por identificador para
+    poder limitar cuántos bytes de cada transferencia quedan pendientes de
+    enviar a este cliente (control de flujo).
+    """
+
+    CARRIL_CONTROL = "control"
+    CARRIL_CHAT = "chat"
+    CARRIL_TRANSFERENCIA = "transferencia"
+    # Pesos por defecto de los carriles que se reparten el ancho de banda.
+    PESOS = {CARRIL_CHAT: 4, CARRIL_TRANSFERENCIA: 1}
+    # Bytes que recibe un carril de peso 1 en cada vuelta.
+    CUANTO = 16 * 1024
+
+    def __init__(self, sock, pesos=None, metricas=None, al_enviar=None):
+        """
+        Args:
+            sock (socket.socket): El socket del cliente.
+            pesos (dict): Peso de cada carril ponderado. {carril: peso} Los carriles
+                que falten toman el peso de `PESOS`.
+            metricas (Metricas): Si se indica, se apunta en ella el tiempo que pasa
+                cada trama en la cola, por carril.
+            al_enviar (callable): Si se indica, el escritor la llama con (conexion,
+                id_transferencia) cada vez que termina de enviar una trama de una
+                transferencia. El servidor la usa para devolver crédito al emisor.
+        """
+        self.sock = sock
+        # Se activa si el cliente negoció la compresión durante el saludo.
+        self.compresion = False
+        self.activa = True
+        self.metricas = metricas
+        self.al_enviar = al_enviar
+        self._pesos = self.completar_pesos(pesos)
+        # Cola de (trama, id_transferencia, instante en que se encoló) de cada carril.
+        self._colas = {carril: deque() for carril in (self.CARRIL_CONTROL, *self._pesos)}
+        # Estado del reparto ponderado: carril al que le toca y bytes que aún puede enviar cada uno.
+        self._ponderados = list(self._pesos)
+        self._turno = 0
+        self._deficit = dict.fromkeys(self._ponderados, 0)
+        # Si el carril al que le toca ya ha recibido su cuanto en esta visita.
+        self._recargado = False
+        # Trama que sale cuando no queda nada más en ningún carril (el aviso 'reconnect').
+        self._despedida = None
+        # Bytes encolados y aún no enviados de cada transferencia. {id: bytes}
+        self._pendiente_transferencias = {}
+        # Bytes de las tramas que esperan en la cola, entre todos los carriles.
+        self._pendiente_total = 0
+        # Indica si el escritor está enviando una trama que ya salió de la cola.
+        self._enviando = False
+        # Una sola Condition protege la cola y despierta al escritor y a quien espera a `drenar`.
+        self._condicion = threading.Condition()
+        self._hilo_escritor = threading.Thread(target=self._bucle_escritura, daemon=True)
+
+    @classmethod
+    def completar_pesos(cls, pesos=None):
+        """
+        Completa los pesos indicados con los de `PESOS` y comprueba que son válidos.
+
+        Raises:
+            ValueError: Si algún carril no existe o su peso no es un entero positivo
+                (con peso 0 el reparto no avanzaría nunca).
+        """
+        pesos = dict(cls.PESOS, **(pesos or {}))
+        for carril, peso in pesos.items():
+            if carril not in cls.PESOS:
+                raise ValueError(f"Carril desconocido: {carril!r}")
+            if isinstance(peso, bool) or not isinstance(peso, int) or peso <= 0:
+                raise ValueError(f"El peso del carril {carril!r} debe ser un entero positivo: {peso!r}")
+        return pesos
+
+    def iniciar(self):
+        """
+        Arranca el hilo escritor de la conexión.
+        """
+        self._hilo_escritor.start()
+
+    def encolar(self, trama, transferencia=None, carril=None):
+        """
+        Añade una trama a la cola de salida sin bloquear.
+
+        Args:
+            trama (bytes): La trama ya empaquetada.
+            transferencia (str): Identificador de la transferencia a la que pertenece, si la hay.
+            carril (str): Carril por el que sale. Por defecto, el de transferencias si
+                `transferencia` está indicado y el de chat si no.
+        """
+        if carril is None:
+            carril = self.CARRIL_TRANSFERENCIA if transferencia is not None else self.CARRIL_CHAT
+        with self._condicion:
+            if not self.activa:
+                return
+            self._colas[carril].append((trama, transferencia, time.monotonic()))
+            self._pendiente_total += len(trama)
+            if transferencia is not None:
+                self._pendiente_transferencias[transferencia] = (
+                    self._pendiente_transferencias.get(transferencia, 0) + len(trama))
+            self._condicion.notify_all()
+
+    def encolar_despedida(self, trama):
+        """
+        Encola una trama que solo sale cuando ya se ha enviado todo lo demás, sea
+        cual sea su carril. Así, quien la recibe ya tiene el resto.
+        """
+        with self._condicion:
+            if not self.activa:
+                return
+            self._despedida = trama
+            self._condicion.notify_all()
+
+    def pendiente(self, transferencia=None):
+        """
+        Devuelve los bytes de una transferencia que aún no se han enviado o, sin
+        `transferencia`, los de todas las tramas que esperan en cualquier carril.
+        """
+        with self._condicion:
+            if transferencia is None:
+                return self._pendiente_total
+            return self._pendiente_transferencias.get(transferencia, 0)
+
+    def descartar_transferencia(self, transferencia):
+        """
+        Elimina de la cola las tramas de una transferencia cancelada.
+        """
+        with self._condicion:
+            for carril, cola in self._colas.items():
+                self._pendiente_total -= sum(len(e[0]) for e in cola if e[1] == transferencia)
+                self._colas[carril] = deque(e for e in cola if e[1] != transferencia)
+            self._pendiente_transferencias.pop(transferencia, None)
+            self._condicion.notify_all()
+
+    def drenar(self, timeout):
+        """
+        Espera a que se envíe todo lo encolado.
+
+        Returns:
+            bool: True si la cola quedó vacía antes del plazo.
+        """
+        with self._condicion:
+            return self._condicion.wait_for(
+                lambda: not self.activa or (not self._hay_pendientes() and not self._enviando),
+                timeout
+            ) and self.activa
+
+    def cerrar(self):
+        """
+        Descarta lo pendiente, detiene el escritor y cierra el socket.
+        """
+        with self._condicion:
+            if not self.activa:
+                return
+            self.activa = False
+            for cola in self._colas.values():
+                cola.clear()
+            self._despedida = None
+            self._pendiente_transferencias.clear()
+            self._pendiente_total = 0
+            self._condicion.notify_all()
+        try:
+            # `shutdown` despierta al hilo que esté bloqueado leyendo de este socket.
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def _hay_pendientes(self):
+        """
+        Indica si queda alguna trama por enviar. Debe llamarse con `_condicion` adquirida.
+        """
+        return self._despedida is not None or any(self._colas.values())
+
+    def _siguiente(self):
+        """
+        Elige la próxima trama: primero el carril de control; si está vacío, el carril
+        ponderado al que le toque según el deficit round robin; y, cuando todo está vacío,
+        la despedida. Debe llamarse con `_condicion` adquirida y algo pendiente.
+
+        Returns:
+            tuple: (trama, id_transferencia, carril, instante en que se encoló)
+        """
+        control = self._colas[self.CARRIL_CONTROL]
+        if control:
+            return self._sacar(self.CARRIL_CONTROL)
+        if not any(self._colas[c] for c in self._ponderados):
+            trama, self._despedida = self._despedida, None
+            return trama, None, None, None
+        while True:
+            carril = self._ponderados[self._turno]
+            cola = self._colas[carril]
+            if cola:
+                if not self._recargado:
+                    self._deficit[carril] += self.CUANTO * self._pesos[carril]
+                    self._recargado = True
+                if len(cola[0][0]) <= self._deficit[carril]:
+                    self._deficit[carril] -= len(cola[0][0])
+                    elemento = self._sacar(carril)
+                    if not cola:
+                        self._pasar_turno()
+                    return elemento
+            # Vacío o sin crédito para su próxima trama: le toca al siguiente.
+            self._pasar_turno()
+
+    def _pasar_turno(self):
+        """
+        Da el turno al siguiente carril ponderado. Un carril vacío pierde el crédito
+        que le sobrara, para que no lo acumule mientras no tiene nada que enviar.
+        """
+        carril = self._ponderados[self._turno]
+        if not self._colas[carril]:
+            self._deficit[carril] = 0
+        self._turno = (self._turno + 1) % len(self._ponderados)
+        self._recargado = False
+
+    def _sacar(self, carril):
+        """
+        Saca la primera trama de un carril.
+        """
+        trama, transferencia, encolada = self._colas[carril].popleft()
+        self._pendiente_total -= len(trama)
+        return trama, transferencia, carril, encolada
+
+    def _bucle_escritura(self):
+        """
+        Bucle del hilo escritor: saca tramas de los carriles y las envía una a una.
+        """
+        while True:
+            with self._condicion:
+                self._condicion.wait_for(lambda: self._hay_pendientes() or not self.activa)
+                if not self.activa:
+                    return
+                trama, transferencia, carril, encolada = self._siguiente()
+                self._enviando = True
+            if self.metricas and carril:
+                espera = time.monotonic() - encolada
+                self.metricas.incrementar(f"cola_{carril}_tramas")
+                self.metricas.incrementar(f"cola_{carril}_espera_segundos", espera)
+                self.metricas.maximo(f"cola_{carril}_espera_max_segundos", espera)
+            try:
+                self.sock.sendall(trama)
+            except OSError as e:
+                logging.error(f"Error al enviar datos: {e}")
+                # Cerrar la conexión hace que el hilo lector detecte la desconexión y limpie.
+                self.cerrar()
+                return
+            with self._condicion:
+                self._enviando = False
+                self._condicion.notify_all()
+                if transferencia is not None:
+                    restante = self._pendiente_transferencias.get(transferencia, 0) - len(trama)
+                    if restante > 0:
+                        self._pendiente_transferencias[transferencia] = restante
+                    else:
+                        self._pendiente_transferencias.pop(transferencia, None)
+            # Fuera del lock: quien nos avisa puede estar encolando en otras conexiones.
+            if transferencia is not None and self.al_enviar:
+                self.al_enviar(self, transferencia)
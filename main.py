@@ -4,6 +4,15 @@ import sys
 from server import Servidor
 from client import Cliente
 
+def _opcion(nombre):
+    """
+    Devuelve el valor que sigue a `nombre` en los argumentos, o None si no aparece.
+    Ejemplo: python main.py server --traspaso /tmp/chat.sock
+    """
+    if nombre in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(nombre) + 1]
+    return None
+
 if __name__ == "__main__":
     # Revisa los argumentos pasados por la línea de comandos.
     # sys.argv es una lista que contiene el nombre del script y los argumentos.
@@ -12,13 +21,17 @@ if __name__ == "__main__":
     # Si se pasa "server" como argumento, o si no se pasa ninguno (para facilitar)
     if len(sys.argv) > 1 and sys.argv[1] == "server":
         # Crea una instancia del servidor y lo inicia.
-        servidor = Servidor()
-        servidor.iniciar()
+        # --traspaso RUTA: espera en ese socket Unix a un proceso nuevo que lo releve.
+        # --heredar RUTA: releva sin cortes al servidor que espera en ese socket Unix.
+        # --unix RUTA: escucha también en ese socket Unix, además de en TCP.
+        servidor = Servidor(ruta_traspaso=_opcion("--traspaso"), ruta_unix=_opcion("--unix"))
+        servidor.iniciar(heredar_de=_opcion("--heredar"))
     # Si se pasa "client" como argumento
     elif len(sys.argv) > 1 and sys.argv[1] == "client":
         # Crea una instancia del cliente y lo inicia.
-        cliente = Cliente()
+        # --unix RUTA: se conecta por ese socket Unix en lugar de por TCP.
+        cliente = Cliente(ruta_unix=_opcion("--unix"))
         cliente.iniciar()
     # Si no se especifica un argumento válido
     else:
-        print("Uso: python main.py [server|client]")
\ No newline at end of file
+        print("Uso: python main.py [server [--traspaso RUTA] [--heredar RUTA] [--unix RUTA]|client [--unix RUTA]]")
@@ -0,0 +1,49 @@
+# metrics.py
+
+import threading
+from collections import defaultdict
+
+"""
+Este módulo define contadores sencillos y seguros entre hilos para que el servidor
+pueda informar de lo que está haciendo (por ejemplo, cuánto ancho de banda ahorra
+la compresión y cuánto CPU le cuesta).
+"""
+
+class Metricas:
+    """
+    Colección de contadores con nombre. Cada hilo de cliente puede incrementarlos
+    a la vez, por eso todas las operaciones pasan por un Lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = defaultdict(int)
+
+    def incrementar(self, nombre, valor=1):
+        """
+        Suma `valor` al contador `nombre` (lo crea a 0 si no existía).
+        """
+        with self._lock:
+            self._contadores[nombre] += valor
+
+    def maximo(self, nombre, valor):
+        """
+        Guarda en `nombre` el mayor valor observado hasta ahora.
+        """
+        with self._lock:
+            if valor > self._contadores[nombre]:
+                self._contadores[nombre] = valor
+
+    def obtener(self, nombre):
+        """
+        Devuelve el valor actual de un contador.
+        """
+        with self._lock:
+            return self._contadores.get(nombre, 0)
+
+    def instantanea(self):
+        """
+        Devuelve una copia de todos los contadores, lista para serializar en JSON.
+        """
+        with self._lock:
+            return dict(self._contadores)
@@ -1,8 +1,10 @@
 # protocol.py
 
+import base64
 import json
 import logging
 import struct
+import zlib
 
 """
 Este módulo define el protocolo de comunicación para el chat.
@@ -15,71 +17,256 @@ class Protocolo:
     Protocolo simple para la comunicación:
     Cada mensaje se envía con un prefijo de 4 bytes que indica el tamaño del payload (contenido),
     seguido del payload en formato JSON.
-    
+
     [ 4 bytes de tamaño ][ Payload en JSON codificado en UTF-8 ]
+
+    El bit más alto del prefijo indica que el payload va comprimido con zlib.
+    Solo se usa con los clientes que lo negociaron durante el saludo inicial
+    (`username_request`), así que los clientes antiguos siempre reciben tramas planas.
+
+    Los archivos grandes no se envían en un único mensaje sino como una transferencia
+    por fragmentos, para no tener el archivo entero en memoria:
+        transfer_start {id, name, size} -> transfer_chunk {id, data} ... -> transfer_end {id}
+    `data` va codificado en base64 y el servidor puede cancelar con transfer_abort {id}.
+    El emisor solo envía tantos fragmentos como crédito tenga: el servidor se lo concede
+    con transfer_credit {id, chunks} al aceptar la transferencia y a medida que los
+    fragmentos salen hacia los destinatarios.
     """
 
+    # Bit del prefijo de tamaño que marca un payload comprimido.
+    BANDERA_COMPRIMIDO = 0x80000000
+    # Tamaño mínimo (en bytes) a partir del cual merece la pena comprimir.
+    UMBRAL_COMPRESION = 512
+    # Códecs de compresión que sabemos negociar, en orden de preferencia.
+    CODECS = ("zlib",)
+    # Tamaño máximo de un payload descomprimido. Sin límite, unos pocos bytes
+    # comprimidos podrían ocupar gigas al descomprimirse.
+    MAXIMO_DESCOMPRIMIDO = 16 * 1024 * 1024
+    # Bytes del archivo que viajan en cada fragmento de una transferencia (antes de base64).
+    TAMAÑO_FRAGMENTO = 48 * 1024
+    # Tamaño máximo de una trama (y de su payload descomprimido). Cabe de sobra un fragmento
+    # en base64; lo que pase de aquí se rechaza antes de leerlo, para que nadie nos haga
+    # reservar memoria con solo declarar un tamaño enorme en el prefijo.
+    MAXIMO_TRAMA = 4 * TAMAÑO_FRAGMENTO
+    # Tipos de mensaje que el servidor difunde con número de secuencia (`seq`) y guarda
+    # en el historial. Son los únicos que cuentan para el `last_seq` de una reanudación.
+    TIPOS_DIFUNDIDOS = ("message", "join", "leave")
+    # Tipos de mensaje que forman una transferencia por fragmentos.
+    TIPOS_TRANSFERENCIA = ("transfer_start", "transfer_chunk", "transfer_end", "transfer_abort")
+
     @staticmethod
-    def enviar(sock, data):
+    def codificar(data):
+        """
+        Convierte un diccionario en el payload JSON codificado en UTF-8.
+        """
+        return json.dumps(data).encode('utf-8')
+
+    @staticmethod
+    def trama(payload, comprimido=False):
+        """
+        Antepone el prefijo de tamaño a un payload ya codificado.
+
+        Args:
+            payload (bytes): El payload (plano o comprimido).
+            comprimido (bool): Si el payload va comprimido; activa la bandera del prefijo.
+        """
+        cabecera = len(payload)
+        if comprimido:
+            cabecera |= Protocolo.BANDERA_COMPRIMIDO
+        # Empaqueta la longitud del payload en 4 bytes, en formato de red (!I).
+        # '!': Orden de bytes de red (big-endian)
+        # 'I': Entero sin signo de 4 bytes
+        return struct.pack('!I', cabecera) + payload
+
+    @staticmethod
+    def trama_comprimida(payload):
+        """
+        Devuelve la trama comprimida de un payload, o None si comprimir no reduce su tamaño.
+        """
+        comprimido = zlib.compress(payload)
+        if len(comprimido) >= len(payload):
+            return None
+        return Protocolo.trama(comprimido, comprimido=True)
+
+    @staticmethod
+    def leer_cabecera(datos_tamaño):
+        """
+        Desempaqueta los 4 bytes del prefijo.
+
+        Returns:
+            tuple: (tamaño del payload, si va comprimido)
+        """
+        cabecera = struct.unpack('!I', datos_tamaño)[0]
+        return cabecera & ~Protocolo.BANDERA_COMPRIMIDO, bool(cabecera & Protocolo.BANDERA_COMPRIMIDO)
+
+    @staticmethod
+    def descomprimir(payload, maximo=MAXIMO_DESCOMPRIMIDO):
+        """
+        Devuelve el payload original de una trama comprimida.
+
+        Raises:
+            ValueError: Si el payload está corrupto o descomprimido supera `maximo` bytes.
+        """
+        descompresor = zlib.decompressobj()
+        try:
+            datos = descompresor.decompress(payload, maximo)
+        except zlib.error as e:
+            raise ValueError(f"Payload comprimido no válido: {e}")
+        if descompresor.unconsumed_tail:
+            raise ValueError(f"El payload descomprimido supera {maximo} bytes.")
+        return datos
+
+    @staticmethod
+    def enviar(sock, data, compresion=False, umbral=UMBRAL_COMPRESION):
         """
         Empaqueta los datos en JSON, calcula su tamaño, y los envía a través del socket.
-        
+
         Args:
             sock (socket.socket): El socket a través del cual se enviará el mensaje.
             data (dict): Un diccionario con los datos a enviar.
+            compresion (bool): Si el otro extremo negoció la compresión.
+            umbral (int): Tamaño del payload a partir del cual se comprime.
         """
         try:
             # Convierte el diccionario de Python a una cadena JSON y luego a bytes.
-            payload = json.dumps(data).encode('utf-8')
-            
-            # Empaqueta la longitud del payload en 4 bytes, en formato de red (!I).
-            # '!': Orden de bytes de red (big-endian)
-            # 'I': Entero sin signo de 4 bytes
-            tamaño = struct.pack('!I', len(payload))
-            
+            payload = Protocolo.codificar(data)
+
+            trama = None
+            if compresion and len(payload) > umbral:
+                trama = Protocolo.trama_comprimida(payload)
+            if trama is None:
+                trama = Protocolo.trama(payload)
+
             # Envía el tamaño seguido del payload. sock.sendall se asegura de que se envíen todos los datos.
-            sock.sendall(tamaño + payload)
-            
+            sock.sendall(trama)
+
         except Exception as e:
             logging.error(f"Error al enviar datos: {e}")
             # Relanzamos la excepción para que el código que llamó a esta función pueda manejarla.
             raise
 
     @staticmethod
-    def recibir(sock):
+    def enviar_trama(sock, trama):
         """
-        Recibe un mensaje, leyendo primero el tamaño y luego el payload correspondiente.
-        
+        Envía una trama ya empaquetada. Permite codificar (y comprimir) un mensaje
+        una sola vez y reutilizar los bytes para varios destinatarios.
+        """
+        try:
+            sock.sendall(trama)
+        except Exception as e:
+            logging.error(f"Error al enviar datos: {e}")
+            raise
+
+    @staticmethod
+    def _recibir_exacto(sock, tamaño):
+        """
+        Lee exactamente `tamaño` bytes del socket, o devuelve None si la conexión se cierra antes.
+        """
+        datos = bytearray()
+        # Leemos datos del socket hasta haber recibido la cantidad de bytes que se pide.
+        while len(datos) < tamaño:
+            # Calculamos cuántos bytes faltan por recibir.
+            chunk = sock.recv(tamaño - len(datos))
+            if not chunk:
+                # La conexión se cerró inesperadamente antes de recibir el bloque completo.
+                return None
+            datos += chunk
+        return bytes(datos)
+
+    @staticmethod
+    def recibir_payload(sock, compresion=True, maximo=MAXIMO_TRAMA):
+        """
+        Recibe una trama y devuelve su payload JSON ya descomprimido, sin decodificarlo.
+        Permite al servidor reenviar los bytes tal cual sin volver a serializarlos.
+
         Args:
             sock (socket.socket): El socket desde el cual se recibirá el mensaje.
-            
+            compresion (bool): Si se aceptan tramas comprimidas. Una trama comprimida
+                de quien no negoció la compresión se rechaza.
+            maximo (int): Tamaño máximo de la trama y de su payload descomprimido, o None
+                para no limitarlo (solo en canales de confianza, como el de traspaso).
+
         Returns:
-            dict: Un diccionario con los datos recibidos, o None si la conexión se cierra o hay un error.
+            bytes: El payload recibido, o None si la conexión se cierra o hay un error.
         """
         try:
             # 1. Leer el prefijo de tamaño (4 bytes)
-            datos_tamaño = sock.recv(4)
+            datos_tamaño = Protocolo._recibir_exacto(sock, 4)
             if not datos_tamaño:
                 # Si no se reciben datos, significa que el otro extremo cerró la conexión.
                 return None
-            
-            # Desempaqueta los 4 bytes para obtener el tamaño del payload.
-            tamaño = struct.unpack('!I', datos_tamaño)[0]
-            
+
+            tamaño, comprimido = Protocolo.leer_cabecera(datos_tamaño)
+            if comprimido and not compresion:
+                logging.error("Trama comprimida sin haber negociado la compresión.")
+                return None
+            if maximo is not None and tamaño > maximo:
+                logging.error(f"Trama de {tamaño} bytes rechazada: el máximo es {maximo}.")
+                return None
+
             # 2. Leer el payload completo
-            payload = b""
-            # Leemos datos del socket hasta haber recibido la cantidad de bytes que indica el tamaño.
-            while len(payload) < tamaño:
-                # Calculamos cuántos bytes faltan por recibir.
-                chunk = sock.recv(tamaño - len(payload))
-                if not chunk:
-                    # La conexión se cerró inesperadamente antes de recibir el mensaje completo.
-                    return None
-                payload += chunk
-            
+            payload = Protocolo._recibir_exacto(sock, tamaño)
+            if payload is None:
+                return None
+            if comprimido:
+                payload = Protocolo.descomprimir(payload, maximo or Protocolo.MAXIMO_DESCOMPRIMIDO)
+            return payload
+
+        except Exception as e:
+            logging.error(f"Error al recibir datos: {e}")
+            return None
+
+    @staticmethod
+    def decodificar(payload):
+        """
+        Convierte un payload JSON en un diccionario, o devuelve None si no es válido.
+        """
+        try:
             # Decodifica los bytes a una cadena JSON y luego la convierte a un diccionario de Python.
             return json.loads(payload.decode('utf-8'))
-            
+
         except Exception as e:
             logging.error(f"Error al recibir datos: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    @staticmethod
+    def recibir(sock, compresion=True, maximo=MAXIMO_TRAMA):
+        """
+        Recibe un mensaje, leyendo primero el tamaño y luego el payload correspondiente.
+
+        Args:
+            sock (socket.socket): El socket desde el cual se recibirá el mensaje.
+            compresion (bool): Si se aceptan tramas comprimidas (ver `recibir_payload`).
+            maximo (int): Tamaño máximo de la trama (ver `recibir_payload`).
+
+        Returns:
+            dict: Un diccionario con los datos recibidos, o None si la conexión se cierra o hay un error.
+        """
+        payload = Protocolo.recibir_payload(sock, compresion, maximo)
+        if payload is None:
+            return None
+        return Protocolo.decodificar(payload)
+
+    @staticmethod
+    def mensajes_transferencia(id_transferencia, nombre, archivo, tamaño):
+        """
+        Genera, uno a uno, los mensajes de una transferencia por fragmentos.
+        El archivo se lee de fragmento en fragmento, nunca entero.
+
+        Args:
+            id_transferencia (str): Identificador único de la transferencia.
+            nombre (str): Nombre del archivo que verán los destinatarios.
+            archivo: Objeto de archivo abierto en modo binario.
+            tamaño (int): Tamaño total del archivo en bytes.
+        """
+        yield {"type": "transfer_start", "id": id_transferencia, "name": nombre, "size": tamaño}
+        while True:
+            fragmento = archivo.read(Protocolo.TAMAÑO_FRAGMENTO)
+            if not fragmento:
+                break
+            yield {
+                "type": "transfer_chunk",
+                "id": id_transferencia,
+                "data": base64.b64encode(fragmento).decode('ascii')
+            }
+        yield {"type": "transfer_end", "id": id_transferencia}
@@ -1,64 +1,238 @@
 # server.py
 
+import os
+import base64
+import errno
+import stat
+import select
 import socket
 import threading
 import logging
+import secrets
+import time
+from collections import deque
 from protocol import Protocolo # Importamos nuestra clase de protocolo
+from connection import Conexion
+from metrics import Metricas
 
 # Configuración básica de logging para mostrar mensajes informativos y de error.
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class Servidor:
-    def __init__(self, host='127.0.0.1', port=55555):
+    # Segundos entre comprobaciones de la bandera `activo` en los bucles que esperan conexiones.
+    INTERVALO_SONDEO = 0.2
+    # Primer byte que envía un proceso nuevo por el canal de traspaso. Distingue al sucesor de
+    # quien solo comprueba si la ruta está en uso (ver `_liberar_ruta_unix`).
+    SOLICITUD_TRASPASO = b"H"
+
+    def __init__(self, host='127.0.0.1', port=55555, compresion=True,
+                 umbral_compresion=Protocolo.UMBRAL_COMPRESION,
+                 ventana_transferencia=4 * 1024 * 1024,
+                 gracia_reanudacion=30.0, tamaño_historial=1000,
+                 ruta_traspaso=None, plazo_drenaje=5.0, ruta_unix=None,
+                 pesos_carriles=None, limite_cola=16 * 1024 * 1024, credito_transferencia=8,
+                 transferencias_por_emisor=4, plazo_transferencia=10.0):
         """
         Inicializa el servidor.
         
         Args:
             host (str): La dirección IP en la que el servidor escuchará.
             port (int): El puerto en el que el servidor escuchará.
+            compresion (bool): Si se ofrece compresión a los clientes durante el saludo.
+            umbral_compresion (int): Tamaño del payload a partir del cual se comprime.
+            ventana_transferencia (int): Bytes de una transferencia que pueden quedar
+                pendientes de enviar a un mismo destinatario. Si los supera, se le cancela.
+                Con el crédito no debería ocurrir: es la defensa ante un emisor que no lo respeta.
+            gracia_reanudacion (float): Segundos durante los que un cliente desconectado
+                puede reanudar su sesión antes de que se anuncie su salida.
+            tamaño_historial (int): Número de mensajes difundidos que se guardan para
+                reenviárselos a quien reanude su sesión.
+            ruta_traspaso (str): Ruta de un socket Unix en el que esperar a un proceso
+                nuevo que herede el socket de escucha (reinicio sin cortes).
+            plazo_drenaje (float): Segundos que se esperan, tras el traspaso, a que se
+                vacíen las colas de salida antes de cerrar las conexiones.
+            ruta_unix (str): Si se indica, el servidor escucha también en este socket
+                Unix, más rápido que TCP para clientes que corren en la misma máquina.
+            pesos_carriles (dict): Reparto del ancho de banda de cada cliente entre el chat
+                y las transferencias, p. ej. {"chat": 4, "transferencia": 1}. Los mensajes
+                de control salen siempre antes (ver `Conexion`).
+            limite_cola (int): Bytes que pueden quedar pendientes de enviar a un cliente
+                entre todos sus carriles. Si los supera, se le cancelan las transferencias
+                que recibe, así que la memoria por cliente está acotada.
+            credito_transferencia (int): Fragmentos que el emisor de una transferencia puede
+                enviar sin que hayan salido aún hacia todos los destinatarios. El servidor
+                le devuelve crédito (`transfer_credit`) a medida que salen.
+            transferencias_por_emisor (int): Transferencias simultáneas de un mismo cliente.
+            plazo_transferencia (float): Segundos que un emisor sin crédito espera a los
+                destinatarios más atrasados antes de cancelárselas a ellos.
         """
         self.host = host
         self.port = port
+        self.compresion = compresion
+        self.umbral_compresion = umbral_compresion
+        self.ventana_transferencia = ventana_transferencia
+        self.gracia_reanudacion = gracia_reanudacion
+        self.ruta_traspaso = ruta_traspaso
+        self.plazo_drenaje = plazo_drenaje
+        self.ruta_unix = ruta_unix
+        # Se validan aquí para que un reparto imposible falle al crear el servidor y no con cada cliente.
+        self.pesos_carriles = Conexion.completar_pesos(pesos_carriles)
+        self.limite_cola = limite_cola
+        self.credito_transferencia = credito_transferencia
+        self.transferencias_por_emisor = transferencias_por_emisor
+        self.plazo_transferencia = plazo_transferencia
         self.socket_servidor = None
+        self.socket_unix = None
+        # Dirección (host, puerto) en la que escucha de verdad; con port=0 la elige el sistema.
+        self.direccion = None
+        # Se activa cuando el servidor ya acepta conexiones.
+        self.listo = threading.Event()
         # Diccionario para almacenar los clientes conectados. {socket: username}
         self.clientes = {}
+        # Cola de salida de cada cliente registrado. {socket: Conexion}
+        self.conexiones = {}
+        # Clientes cuyo registro ya terminó: su 'join' está difundido o su sesión reanudada.
+        # Es lo que cuenta `esperar_clientes`. {socket}
+        self.registrados = set()
+        # Transferencias por fragmentos en curso. {id: {"emisor": socket, "destinatarios": {socket: Conexion},
+        # "recibidos", "concedidos", "enviados": {Conexion: tramas}, "temporizador"}} (ver `_actualizar_credito`)
+        self.transferencias = {}
+        # Número de secuencia del último mensaje difundido. Solo crece.
+        self.secuencia = 0
+        # Últimos mensajes difundidos: (seq, token del emisor, payload). Acotado para no crecer sin límite.
+        self.historial = deque(maxlen=tamaño_historial)
+        # Sesiones reanudables. {token: {"username", "socket" (None si está suspendida), "temporizador"}}
+        self.sesiones = {}
+        # Token de sesión de cada cliente conectado que la pidió. {socket: token}
+        self.tokens = {}
+        # Contadores de actividad del servidor (se consultan con un mensaje 'stats').
+        self.metricas = Metricas()
         # Un Lock para evitar problemas de concurrencia al modificar la lista de clientes desde múltiples hilos.
         self.lock_clientes = threading.Lock()
+        # Avisa de cada alta o baja en `registrados` (ver `esperar_clientes`). Comparte el lock.
+        self.cambio_clientes = threading.Condition(self.lock_clientes)
         #bandera para controlar el bucle principal 
         self.activo = False
         self.hilo_principal = None
+        self.hilo_traspaso = None
+        # Par de sockets para despertar al bucle de aceptación al detener el servidor,
+        # en lugar de esperar a que venza el `select` (ver `detener`).
+        self._despertador = None
+        # `detener` puede llamarse a la vez desde el hilo de traspaso y desde fuera.
+        self._lock_parada = threading.Lock()
+        # Se activa cuando otro proceso ha heredado el socket de escucha.
+        self.cedido = False
 
-    def iniciar(self):
+    def iniciar(self, heredar_de=None):
         """
         Inicia el servidor, lo enlaza a la dirección/puerto y comienza a escuchar conexiones.
+
+        Args:
+            heredar_de (str): Ruta del socket Unix de traspaso de un servidor en marcha.
+                Si se indica, en lugar de enlazar un socket nuevo se hereda el suyo
+                (junto con sus sesiones), y el servidor anterior se retira.
         """
-        # Crea un socket TCP/IP (IPv4).
-        self.socket_servidor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Permite reutilizar la dirección del socket inmediatamente después de cerrarlo.
-        self.socket_servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # Enlaza el socket a la dirección y puerto especificados.
-        self.socket_servidor.bind((self.host, self.port))
-        # Pone el servidor en modo de escucha, aceptando hasta 5 conexiones en cola.
-        self.socket_servidor.listen(5)
-        logging.info(f'Servidor escuchando en {self.host}:{self.port}')
+        if heredar_de:
+            self._heredar(heredar_de)
+            logging.info(f'Servidor heredado desde {heredar_de}')
+        else:
+            # Crea un socket TCP/IP (IPv4).
+            self.socket_servidor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Permite reutilizar la dirección del socket inmediatamente después de cerrarlo.
+            self.socket_servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Enlaza el socket a la dirección y puerto especificados.
+            self.socket_servidor.bind((self.host, self.port))
+            # Pone el servidor en modo de escucha. Con una cola corta, las conexiones que llegan
+            # en ráfaga (muchos clientes arrancando a la vez) se rechazan o se retrasan.
+            self.socket_servidor.listen(socket.SOMAXCONN)
+        if self.ruta_unix and self.socket_unix is None:
+            # Si la ruta ya existe puede ser de una ejecución anterior que no la limpió.
+            self._liberar_ruta_unix(self.ruta_unix)
+            self.socket_unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket_unix.bind(self.ruta_unix)
+            self.socket_unix.listen(socket.SOMAXCONN)
+            logging.info(f'Servidor escuchando en {self.ruta_unix}')
+        # El bucle de aceptación espera con `select`, así que puede pararse sin cerrar
+        # los sockets, que durante un traspaso están compartidos con otro proceso.
+        for escucha in self._sockets_escucha():
+            escucha.setblocking(False)
+        self.direccion = self.socket_servidor.getsockname()[:2]
+        if not heredar_de:
+            logging.info(f'Servidor escuchando en {self.direccion[0]}:{self.direccion[1]}')
         
+        # Si se configuró, esperamos a que un proceso nuevo venga a relevarnos. El canal se
+        # abre aquí, antes de aceptar a nadie, para que una ruta ocupada haga fallar `iniciar`.
+        canal = None
+        if self.ruta_traspaso:
+            # Si la ruta existe es de un proceso anterior (quizá el que acabamos de relevar,
+            # que ya cerró su canal al aceptarnos).
+            self._liberar_ruta_unix(self.ruta_traspaso)
+            canal = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            canal.bind(self.ruta_traspaso)
+            canal.listen(1)
+
+        self._despertador = socket.socketpair()
         self.activo = True
         # --- CAMBIO: El bucle de aceptación ahora corre en su propio hilo ---
         self.hilo_principal = threading.Thread(target=self._bucle_aceptacion)
         self.hilo_principal.start()
 
+        if canal:
+            self.hilo_traspaso = threading.Thread(target=self._esperar_sucesor, args=(canal,))
+            self.hilo_traspaso.start()
+        self.listo.set()
+
+    def esperar_clientes(self, cantidad, timeout=None):
+        """
+        Espera hasta que haya al menos `cantidad` clientes registrados (con nombre de usuario).
+        Evita esperas fijas en pruebas y herramientas de carga antes de empezar a enviar.
+        Un cliente cuenta cuando su 'join' ya está numerado y encolado para los demás, así
+        que todo lo que se difunda después les llega detrás.
+
+        Returns:
+            bool: True si se alcanzó la cantidad, False si se agotó el tiempo.
+        """
+        with self.cambio_clientes:
+            return self.cambio_clientes.wait_for(lambda: len(self.registrados) >= cantidad, timeout)
+
     # Método para detener el servidor de forma controlada ---
-    def detener(self):
+    def detener(self, plazo_drenaje=None):
         """
         Detiene el servidor de forma segura.
+
+        Args:
+            plazo_drenaje (float): Si se indica, parada ordenada: se avisa a los clientes
+                para que se reconecten y se espera, como mucho este número de segundos,
+                a que sus colas de salida se vacíen antes de cerrarlas.
         """
-        self.activo = False
-        # Cierra el socket para desbloquear la llamada a `accept()` en el bucle.
-        if self.socket_servidor:
-            self.socket_servidor.close()
-        # Espera a que el hilo principal termine.
-        if self.hilo_principal:
-            self.hilo_principal.join()
+        # Cada paso es idempotente y el lock evita que dos llamadas se pisen.
+        with self._lock_parada:
+            self.activo = False
+            self.listo.clear()
+            self._despertar()
+            # Espera a que el hilo principal termine.
+            if self.hilo_principal and self.hilo_principal is not threading.current_thread():
+                self.hilo_principal.join()
+            if self._despertador:
+                for extremo in self._despertador:
+                    extremo.close()
+                self._despertador = None
+            if plazo_drenaje is not None:
+                self._drenar(plazo_drenaje)
+            # Las sesiones suspendidas ya no se van a reanudar en este proceso.
+            with self.lock_clientes:
+                for sesion in self.sesiones.values():
+                    if sesion["temporizador"]:
+                        sesion["temporizador"].cancel()
+            # Cerrar solo suelta nuestra referencia: si otro proceso heredó el socket, sigue escuchando.
+            for escucha in self._sockets_escucha():
+                escucha.close()
+            # La ruta del socket Unix pasa a ser del sucesor si lo hay; si no, la limpiamos.
+            if self.socket_unix and not self.cedido and os.path.exists(self.ruta_unix):
+                os.unlink(self.ruta_unix)
+        # Fuera del lock: el hilo de traspaso puede estar esperándolo dentro de su propio `detener`.
+        if self.hilo_traspaso and self.hilo_traspaso is not threading.current_thread():
+            self.hilo_traspaso.join()
         logging.info("Servidor detenido.")
 
     def _bucle_aceptacion(self):
@@ -66,35 +240,235 @@ class Servidor:
         Bucle principal que acepta nuevas conexiones de clientes.
         Se ejecuta en un hilo separado.
         """
+        aviso = self._despertador[0]
         # --- CAMBIO: El bucle ahora depende de la bandera `self.activo` ---
         while self.activo:
             try:
-                socket_cliente, direccion = self.socket_servidor.accept()
-                logging.info(f'Conexión aceptada desde {direccion}')
-                
-                hilo_cliente = threading.Thread(
-                    target=self._manejar_cliente,
-                    args=(socket_cliente,),
-                    daemon=True
-                )
-                hilo_cliente.start()
+                listos, _, _ = select.select(self._sockets_escucha() + [aviso], [], [], self.INTERVALO_SONDEO)
+                if aviso in listos:
+                    break
+                for escucha in listos:
+                    socket_cliente, direccion = escucha.accept()
+                    socket_cliente.setblocking(True)
+                    # Los clientes de un socket Unix no tienen dirección propia.
+                    logging.info(f'Conexión aceptada desde {direccion or self.ruta_unix}')
+                    
+                    hilo_cliente = threading.Thread(
+                        target=self._manejar_cliente,
+                        args=(socket_cliente,),
+                        daemon=True
+                    )
+                    hilo_cliente.start()
+            except BlockingIOError:
+                # Durante un traspaso, el otro proceso aceptó esta conexión antes que nosotros.
+                continue
             except OSError:
-                # Ocurre un error cuando cerramos el socket en `detener()`.
+                # Ocurre un error si el socket se cierra mientras esperamos.
                 # Es normal, simplemente salimos del bucle.
                 if self.activo:
                     logging.error("Error en el socket del servidor.")
                 break
 
+    def _despertar(self):
+        """
+        Despierta al bucle de aceptación para que compruebe `activo` sin esperar al sondeo.
+        """
+        despertador = self._despertador
+        if despertador:
+            try:
+                despertador[1].send(b"\0")
+            except OSError:
+                pass
+
+    def _sockets_escucha(self):
+        """
+        Devuelve los sockets en los que el servidor acepta conexiones (TCP y, si hay, Unix).
+        """
+        return [s for s in (self.socket_servidor, self.socket_unix) if s is not None]
+
+    def conectar_local(self):
+        """
+        Transporte en el mismo proceso: crea un par de sockets conectados con
+        `socketpair`, atiende un extremo como a cualquier cliente y devuelve el otro.
+        Útil para incrustar el servidor en pruebas y herramientas sin pasar por la red.
+
+        Returns:
+            socket.socket: El extremo del cliente, que habla el mismo `Protocolo`.
+        """
+        socket_cliente, socket_servidor = socket.socketpair()
+        threading.Thread(target=self._manejar_cliente, args=(socket_servidor,), daemon=True).start()
+        return socket_cliente
+
+    def _drenar(self, plazo):
+        """
+        Pide a los clientes que se reconecten y espera a que sus colas se vacíen
+        (como mucho `plazo` segundos en total) antes de cerrar sus conexiones.
+        """
+        with self.lock_clientes:
+            conexiones = list(self.conexiones.values())
+        aviso = Protocolo.trama(Protocolo.codificar({"type": "reconnect"}))
+        for conexion in conexiones:
+            # El aviso va detrás de todo lo pendiente, así que al recibirlo el cliente ya tiene el resto.
+            conexion.encolar_despedida(aviso)
+            self._registrar_envio(aviso, aviso)
+        limite = time.monotonic() + plazo
+        for conexion in conexiones:
+            if not conexion.drenar(max(0.0, limite - time.monotonic())):
+                self.metricas.incrementar("drenaje_colas_incompletas")
+            conexion.cerrar()
+        logging.info(f'{len(conexiones)} conexiones drenadas.')
+
+    @staticmethod
+    def _liberar_ruta_unix(ruta):
+        """
+        Borra el socket Unix que una ejecución anterior dejó en `ruta`, si lo hay.
+
+        Raises:
+            FileExistsError: Si la ruta existe y no es un socket (p. ej. un archivo
+                normal con la ruta mal escrita): nunca lo borramos.
+            OSError: Con `errno.EADDRINUSE`, si otro servidor sigue escuchando en ella.
+        """
+        try:
+            modo = os.lstat(ruta).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(modo):
+            raise FileExistsError(errno.EEXIST, "La ruta existe y no es un socket Unix", ruta)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sonda:
+            try:
+                sonda.connect(ruta)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nadie escucha: es un resto de una ejecución anterior.
+                pass
+            else:
+                raise OSError(errno.EADDRINUSE, "Otro servidor escucha en la ruta", ruta)
+        os.unlink(ruta)
+
+    def _esperar_sucesor(self, canal):
+        """
+        Escucha en el socket Unix de traspaso. Cuando un proceso nuevo se conecta, le pasa
+        los descriptores de los sockets de escucha y el estado de las sesiones, y este servidor
+        se retira de forma ordenada. Se ejecuta en un hilo separado.
+        """
+        sucesor = None
+        try:
+            while self.activo and sucesor is None:
+                listos, _, _ = select.select([canal], [], [], self.INTERVALO_SONDEO)
+                if listos:
+                    sucesor = self._aceptar_sucesor(canal)
+            if sucesor is None:
+                # Parada normal sin sucesor: la ruta es nuestra y la limpiamos.
+                os.unlink(self.ruta_traspaso)
+                return
+        finally:
+            canal.close()
+
+        with sucesor:
+            # Dejamos de aceptar antes de copiar el estado, para que nadie se quede a medias.
+            self.activo = False
+            self._despertar()
+            self.hilo_principal.join()
+            with self.lock_clientes:
+                # A partir de aquí no difundimos nada: el sucesor continúa la numeración.
+                self.cedido = True
+                estado = self._exportar_estado()
+            socket.send_fds(sucesor, [b"F"], [escucha.fileno() for escucha in self._sockets_escucha()])
+            Protocolo.enviar(sucesor, estado)
+        logging.info("Socket de escucha traspasado al nuevo proceso.")
+        self.detener(plazo_drenaje=self.plazo_drenaje)
+
+    def _aceptar_sucesor(self, canal):
+        """
+        Acepta una conexión en el canal de traspaso y la devuelve solo si pide el traspaso.
+        Una sonda que conecta y se va (otro servidor comprobando la ruta) se descarta.
+        """
+        conexion, _ = canal.accept()
+        try:
+            conexion.settimeout(self.INTERVALO_SONDEO * 5)
+            if conexion.recv(1) == self.SOLICITUD_TRASPASO:
+                conexion.settimeout(None)
+                return conexion
+        except OSError:
+            pass
+        conexion.close()
+        return None
+
+    def _heredar(self, ruta):
+        """
+        Se conecta al servidor en marcha por su socket Unix de traspaso y recibe sus
+        sockets de escucha (TCP y, si lo tenía, Unix) y el estado de sus sesiones.
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as canal:
+            canal.connect(ruta)
+            canal.sendall(self.SOLICITUD_TRASPASO)
+            _, descriptores, _, _ = socket.recv_fds(canal, 1, 2)
+            if not descriptores:
+                raise OSError(f"No se recibió ningún socket de escucha desde {ruta}")
+            # El estado incluye el historial entero, así que no cabe en una trama normal.
+            estado = Protocolo.recibir(canal, maximo=None)
+        for descriptor in descriptores:
+            # `socket(fileno=...)` detecta la familia del socket heredado.
+            escucha = socket.socket(fileno=descriptor)
+            if escucha.family == socket.AF_UNIX:
+                self.socket_unix = escucha
+                self.ruta_unix = escucha.getsockname()
+            else:
+                self.socket_servidor = escucha
+        if estado:
+            self._importar_estado(estado)
+
+    def _exportar_estado(self):
+        """
+        Resume la numeración, el historial y las sesiones en un diccionario serializable.
+        Incluye a los clientes conectados sin sesión: no pueden seguir en el proceso nuevo,
+        y es el sucesor quien tiene que anunciar su salida. Debe llamarse con `lock_clientes`
+        adquirido.
+        """
+        return {
+            "seq": self.secuencia,
+            "history": [[seq, origen, base64.b64encode(payload).decode('ascii')]
+                        for seq, origen, payload in self.historial],
+            "sessions": {token: sesion["username"] for token, sesion in self.sesiones.items()},
+            "leaving": [nombre for s, nombre in self.clientes.items() if s not in self.tokens]
+        }
+
+    def _importar_estado(self, estado):
+        """
+        Continúa la numeración y el historial del servidor anterior. Sus sesiones quedan
+        suspendidas durante el plazo de gracia, a la espera de que los clientes se reconecten,
+        y se anuncia la salida de sus clientes sin sesión, que no pueden seguir en este proceso.
+        """
+        with self.lock_clientes:
+            self.secuencia = estado.get("seq", 0)
+            for seq, origen, payload in estado.get("history", []):
+                self.historial.append((seq, origen, base64.b64decode(payload)))
+            for token, nombre_usuario in estado.get("sessions", {}).items():
+                temporizador = threading.Timer(self.gracia_reanudacion, self._expirar_sesion, args=(token,))
+                temporizador.daemon = True
+                self.sesiones[token] = {"username": nombre_usuario, "socket": None, "temporizador": temporizador}
+                temporizador.start()
+        for nombre_usuario in estado.get("leaving", []):
+            logging.info(f'{nombre_usuario} ha abandonado el chat.')
+            self.broadcast({"type": "leave", "username": nombre_usuario}, None)
+
     def _manejar_cliente(self, socket_cliente):
         """
         Gestiona la conexión de un cliente individual: recibe su nombre y sus mensajes.
         Esta función se ejecuta en un hilo separado por cada cliente.
         """
         nombre_usuario = None
+        # Todo lo que se envía a este cliente pasa por su cola de salida.
+        conexion = Conexion(socket_cliente, self.pesos_carriles, self.metricas, self._trama_transferencia_enviada)
+        conexion.iniciar()
         try:
             # 1. Solicitar y recibir el nombre de usuario.
-            Protocolo.enviar(socket_cliente, {"type": "username_request"})
-            respuesta = Protocolo.recibir(socket_cliente)
+            # Si la compresión está activada, ofrecemos los códecs que conocemos.
+            solicitud = {"type": "username_request"}
+            if self.compresion:
+                solicitud["compression"] = list(Protocolo.CODECS)
+            self._enviar(conexion, solicitud)
+            # La compresión aún no está negociada: el saludo tiene que llegar plano.
+            respuesta = Protocolo.recibir(socket_cliente, compresion=False)
             
             if not respuesta or "username" not in respuesta:
                 # Si el cliente no envía un nombre de usuario válido, se cierra la conexión.
@@ -107,14 +481,34 @@ class Servidor:
             # 2. Registrar al cliente y notificar a los demás.
             # Usamos 'with self.lock_clientes:' para asegurar que solo un hilo a la vez modifique el diccionario.
             with self.lock_clientes:
+                conexion.compresion = self.compresion and respuesta.get("compression") in Protocolo.CODECS
+                sesion = self.sesiones.get(respuesta.get("resume_token"))
+                if sesion is not None:
+                    # Reanuda la sesión anterior: mismo usuario y sin anunciar un nuevo 'join'.
+                    nombre_usuario = sesion["username"]
                 self.clientes[socket_cliente] = nombre_usuario
+                self.conexiones[socket_cliente] = conexion
+                if sesion is not None:
+                    self._reanudar_sesion(socket_cliente, conexion, respuesta)
+                elif respuesta.get("resume") or "resume_token" in respuesta:
+                    self._crear_sesion(socket_cliente, conexion, nombre_usuario)
             
-            logging.info(f'{nombre_usuario} se ha unido al chat.')
-            self.broadcast({"type": "join", "username": nombre_usuario}, socket_cliente)
+            if sesion is not None:
+                logging.info(f'{nombre_usuario} ha reanudado su sesión.')
+            else:
+                logging.info(f'{nombre_usuario} se ha unido al chat.')
+                self.broadcast({"type": "join", "username": nombre_usuario}, socket_cliente)
+            # Hasta ahora no cuenta para `esperar_clientes`: así el 'join' ya ha salido.
+            with self.cambio_clientes:
+                if socket_cliente in self.clientes:
+                    self.registrados.add(socket_cliente)
+                    self.cambio_clientes.notify_all()
 
             # 3. Bucle para recibir mensajes del cliente.
             while True:
-                mensaje = Protocolo.recibir(socket_cliente)
+                # Guardamos el payload en bytes para poder reenviar fragmentos sin volver a serializarlos.
+                payload = Protocolo.recibir_payload(socket_cliente, compresion=conexion.compresion)
+                mensaje = Protocolo.decodificar(payload) if payload is not None else None
                 if not mensaje:
                     # Si `recibir` devuelve None, el cliente se desconectó.
                     break
@@ -127,12 +521,38 @@ class Servidor:
                         "text": mensaje.get("text", "")
                     }, socket_cliente)
 
+                # Los fragmentos de archivos se reenvían uno a uno, sin acumularlos.
+                elif mensaje.get("type") in Protocolo.TIPOS_TRANSFERENCIA:
+                    self._gestionar_transferencia(socket_cliente, nombre_usuario, mensaje, payload)
+
+                # Si se despide explícitamente, su sesión no se puede reanudar.
+                elif mensaje.get("type") == "leave":
+                    with self.lock_clientes:
+                        self.sesiones.pop(self.tokens.pop(socket_cliente, None), None)
+                    break
+
+                # Si pide las estadísticas, se las enviamos solo a él.
+                elif mensaje.get("type") == "stats":
+                    self._enviar(conexion, {
+                        "type": "stats",
+                        "metrics": self.metricas.instantanea()
+                    })
+
+                # Latido: se contesta por el carril de control, sin esperar a nada de lo encolado.
+                elif mensaje.get("type") == "ping":
+                    pong = {"type": "pong"}
+                    if "id" in mensaje:
+                        pong["id"] = mensaje["id"]
+                    self._enviar(conexion, pong)
+
         except Exception as e:
             logging.error(f"Error con el cliente {nombre_usuario}: {e}")
         
         finally:
             # 4. Limpieza: eliminar al cliente cuando se desconecta o hay un error.
             self._eliminar_cliente(socket_cliente, nombre_usuario)
+            # Cierra también las conexiones que nunca llegaron a registrarse.
+            conexion.cerrar()
             
         # -- ADD THIS NEW PRIVATE METHOD AFTER TDD REFACTOR --
     def _es_mensaje_valido(self, mensaje: dict) -> bool:
@@ -168,29 +588,355 @@ class Servidor:
                 # --- TDD REFACTOR: Replace the old logic with a call to the new method ---
         if not self._es_mensaje_valido(mensaje):
             return # Stop if the message is invalid
-        
+
+        with self.lock_clientes:
+            if self.cedido:
+                # El sucesor ya tiene nuestra numeración, así que no podemos difundirlo. En vez
+                # de perder un mensaje de chat en silencio se lo devolvemos al emisor, que lo
+                # reenvía al reanudar su sesión en el proceso nuevo. Los 'leave' de quien no
+                # tenía sesión los anuncia el sucesor (ver `_exportar_estado`).
+                if mensaje.get("type") == "message":
+                    self.metricas.incrementar("mensajes_descartados_traspaso")
+                    conexion_emisor = self.conexiones.get(socket_emisor)
+                    if conexion_emisor:
+                        self._enviar(conexion_emisor, {
+                            "type": "rejected",
+                            "reason": "restart",
+                            "message": {"type": "message", "text": mensaje.get("text", "")}
+                        })
+                return
+            # Numeramos el mensaje y lo guardamos para quien tenga que reanudar su sesión.
+            self.secuencia += 1
+            mensaje = dict(mensaje, seq=self.secuencia)
+            # Codificamos (y, si hace falta, comprimimos) una sola vez para todos los destinatarios.
+            payload = Protocolo.codificar(mensaje)
+            self.historial.append((self.secuencia, self.tokens.get(socket_emisor), payload))
+            destinatarios = [c for s, c in self.conexiones.items() if s != socket_emisor]
+            # Encolar no bloquea, así que mantener el lock conserva el mismo orden para todos.
+            self._difundir_payload(payload, destinatarios)
+
+    def _difundir_payload(self, payload, destinatarios, transferencia=None, carril=None):
+        """
+        Encola un payload ya codificado en varias conexiones. La trama plana se construye
+        una vez y la comprimida, como mucho, otra; los bytes se comparten entre destinatarios.
+        El carril por defecto es el que elija `Conexion.encolar`.
+        """
+        trama_plana = Protocolo.trama(payload)
+        trama_comprimida = None
+        comprimir = len(payload) > self.umbral_compresion
+        for conexion in destinatarios:
+            trama = trama_plana
+            if comprimir and conexion.compresion:
+                if trama_comprimida is None:
+                    trama_comprimida = self._comprimir(payload)
+                if trama_comprimida:
+                    trama = trama_comprimida
+                else:
+                    # No se gana nada comprimiendo este payload; no lo reintentamos.
+                    comprimir = False
+            conexion.encolar(trama, transferencia, carril)
+            self._registrar_envio(trama_plana, trama)
+
+    def _enviar(self, conexion, mensaje, carril=Conexion.CARRIL_CONTROL):
+        """
+        Envía un mensaje a un único cliente, comprimiéndolo si lo negoció.
+        Por defecto va por el carril de control, por delante del chat y las transferencias.
+        """
+        self._difundir_payload(Protocolo.codificar(mensaje), [conexion], carril=carril)
+
+    def _crear_sesion(self, socket_cliente, conexion, nombre_usuario):
+        """
+        Crea una sesión reanudable y envía su token al cliente.
+        Debe llamarse con `lock_clientes` adquirido.
+        """
+        token = secrets.token_urlsafe(16)
+        self.sesiones[token] = {"username": nombre_usuario, "socket": socket_cliente, "temporizador": None}
+        self.tokens[socket_cliente] = token
+        self._enviar(conexion, {"type": "session", "resume_token": token, "seq": self.secuencia, "resumed": False})
+
+    def _reanudar_sesion(self, socket_cliente, conexion, respuesta):
+        """
+        Asocia una sesión existente a la nueva conexión y le reenvía, del historial,
+        los mensajes difundidos después de `last_seq`. Debe llamarse con `lock_clientes`
+        adquirido, para que ningún mensaje nuevo se cuele entre los reenviados.
+        """
+        token = respuesta["resume_token"]
+        sesion = self.sesiones[token]
+        if sesion["temporizador"]:
+            sesion["temporizador"].cancel()
+        anterior = sesion["socket"]
+        if anterior is not None:
+            # El servidor aún no había notado la caída de la conexión anterior: la soltamos
+            # sin anunciar su salida.
+            self.clientes.pop(anterior, None)
+            self.registrados.discard(anterior)
+            self.tokens.pop(anterior, None)
+            conexion_anterior = self.conexiones.pop(anterior, None)
+            if conexion_anterior:
+                conexion_anterior.cerrar()
+        sesion["socket"] = socket_cliente
+        sesion["temporizador"] = None
+        self.tokens[socket_cliente] = token
+
+        ultima = respuesta.get("last_seq")
+        if not isinstance(ultima, int):
+            ultima = self.secuencia
+        # Si el historial ya no llega hasta `last_seq`, avisamos de que hay un hueco.
+        primera_disponible = self.historial[0][0] if self.historial else self.secuencia + 1
+        self._enviar(conexion, {
+            "type": "session",
+            "resume_token": token,
+            "seq": self.secuencia,
+            "resumed": True,
+            "gap": ultima + 1 < primera_disponible
+        })
+        perdidos = [payload for seq, origen, payload in self.historial if seq > ultima and origen != token]
+        for payload in perdidos:
+            self._difundir_payload(payload, [conexion])
+        self.metricas.incrementar("sesiones_reanudadas")
+        self.metricas.incrementar("tramas_reenviadas", len(perdidos))
+
+    def _expirar_sesion(self, token):
+        """
+        Se ejecuta cuando termina el plazo de gracia de una sesión suspendida:
+        la descarta y anuncia, ahora sí, la salida del usuario.
+        """
         with self.lock_clientes:
-            for cliente in list(self.clientes.keys()):
-                if cliente != socket_emisor:
-                    try:
-                        Protocolo.enviar(cliente, mensaje)
-                    except Exception:
-                        self._eliminar_cliente(cliente, self.clientes.get(cliente))
+            sesion = self.sesiones.get(token)
+            if sesion is None or sesion["socket"] is not None:
+                # Se reanudó justo a tiempo.
+                return
+            del self.sesiones[token]
+        logging.info(f'{sesion["username"]} ha abandonado el chat.')
+        self.broadcast({"type": "leave", "username": sesion["username"]}, None)
+
+    def _gestionar_transferencia(self, socket_emisor, nombre_usuario, mensaje, payload):
+        """
+        Reenvía los mensajes de una transferencia por fragmentos a los clientes que
+        estaban conectados cuando empezó. Cada fragmento se lee una vez y se reenvía
+        con los mismos bytes. El emisor solo envía los fragmentos para los que tiene
+        crédito (ver `_actualizar_credito`); si aun así un destinatario acumula más de
+        `ventana_transferencia` bytes de la transferencia, o más de `limite_cola` en
+        total, se le cancela.
+        """
+        tipo = mensaje.get("type")
+        id_transferencia = mensaje.get("id")
+
+        if tipo == "transfer_start":
+            with self.lock_clientes:
+                conexion_emisor = self.conexiones.get(socket_emisor)
+                if not isinstance(id_transferencia, str) or id_transferencia in self.transferencias:
+                    # El identificador lo elige el emisor; si ya está en uso, rechazamos la transferencia.
+                    self._enviar(conexion_emisor, {"type": "transfer_abort", "id": id_transferencia})
+                    return
+                en_curso = sum(1 for t in self.transferencias.values() if t["emisor"] is socket_emisor)
+                if en_curso >= self.transferencias_por_emisor:
+                    self._enviar(conexion_emisor, {"type": "transfer_abort", "id": id_transferencia, "reason": "limit"})
+                    return
+                destinatarios = {s: c for s, c in self.conexiones.items() if s != socket_emisor}
+                self.transferencias[id_transferencia] = {
+                    "emisor": socket_emisor,
+                    "destinatarios": destinatarios,
+                    "recibidos": 0,
+                    "concedidos": self.credito_transferencia,
+                    "enviados": {},
+                    "temporizador": None
+                }
+                self._difundir_payload(Protocolo.codificar({
+                    "type": "transfer_start",
+                    "id": id_transferencia,
+                    "username": nombre_usuario,
+                    "name": mensaje.get("name", ""),
+                    "size": mensaje.get("size")
+                }), list(destinatarios.values()), id_transferencia)
+                self._enviar(conexion_emisor, {
+                    "type": "transfer_credit", "id": id_transferencia, "chunks": self.credito_transferencia
+                })
+            return
+
+        with self.lock_clientes:
+            transferencia = self.transferencias.get(id_transferencia)
+            if not transferencia or transferencia["emisor"] is not socket_emisor:
+                # Ignoramos fragmentos de transferencias ajenas o que ya terminaron.
+                return
+            destinatarios = dict(transferencia["destinatarios"])
+            if tipo == "transfer_chunk":
+                transferencia["recibidos"] += 1
+            else:
+                del self.transferencias[id_transferencia]
+                if transferencia["temporizador"]:
+                    transferencia["temporizador"].cancel()
+
+        if tipo == "transfer_chunk":
+            # Control de flujo sin esperar: este hilo es el que lee al emisor, y si se
+            # bloqueara por un destinatario lento también se pararía el chat del emisor.
+            # Quien ya tiene la ventana o su cola llenas es porque el emisor no respetó
+            # el crédito: se le cancela la transferencia en lugar de acumularla.
+            for socket_destino, conexion in list(destinatarios.items()):
+                if (conexion.pendiente(id_transferencia) >= self.ventana_transferencia
+                        or conexion.pendiente() >= self.limite_cola):
+                    del destinatarios[socket_destino]
+                    self._cancelar_destinatario(id_transferencia, socket_destino, conexion)
+            self.metricas.incrementar("transferencia_fragmentos")
+            self.metricas.incrementar("transferencia_bytes", len(payload))
+            self._difundir_payload(payload, list(destinatarios.values()), id_transferencia)
+            with self.lock_clientes:
+                self._actualizar_credito(id_transferencia)
+        else:
+            # transfer_end o transfer_abort del emisor: se reenvía y la transferencia termina.
+            # Va por el mismo carril que los fragmentos para no adelantarlos.
+            self._difundir_payload(payload, list(destinatarios.values()), carril=Conexion.CARRIL_TRANSFERENCIA)
+
+    def _trama_transferencia_enviada(self, conexion, id_transferencia):
+        """
+        Lo llama el escritor de una conexión cada vez que termina de enviar una trama
+        de una transferencia. Puede liberar crédito para el emisor.
+        """
+        with self.lock_clientes:
+            transferencia = self.transferencias.get(id_transferencia)
+            if transferencia is None:
+                return
+            transferencia["enviados"][conexion] = transferencia["enviados"].get(conexion, 0) + 1
+            self._actualizar_credito(id_transferencia)
+
+    def _actualizar_credito(self, id_transferencia):
+        """
+        Devuelve al emisor el crédito de los fragmentos que ya han salido hacia todos los
+        destinatarios que quedan, de modo que nunca tenga más de `credito_transferencia`
+        fragmentos en las colas del servidor. Si se queda sin crédito, arranca el plazo
+        tras el que se cancela a los destinatarios atrasados. Debe llamarse con
+        `lock_clientes` adquirido.
+        """
+        transferencia = self.transferencias.get(id_transferencia)
+        if transferencia is None:
+            return
+        destinatarios = transferencia["destinatarios"].values()
+        completados = transferencia["recibidos"]
+        if destinatarios:
+            # La primera trama de cada destinatario es el transfer_start.
+            completados = min(completados, min(transferencia["enviados"].get(c, 0) for c in destinatarios) - 1)
+        nuevos = completados + self.credito_transferencia - transferencia["concedidos"]
+        if nuevos > 0:
+            transferencia["concedidos"] += nuevos
+            if transferencia["temporizador"]:
+                transferencia["temporizador"].cancel()
+                transferencia["temporizador"] = None
+            conexion_emisor = self.conexiones.get(transferencia["emisor"])
+            if conexion_emisor:
+                self._enviar(conexion_emisor, {"type": "transfer_credit", "id": id_transferencia, "chunks": nuevos})
+        elif transferencia["recibidos"] >= transferencia["concedidos"] and not transferencia["temporizador"]:
+            temporizador = threading.Timer(self.plazo_transferencia, self._cancelar_atrasados, args=(id_transferencia,))
+            temporizador.daemon = True
+            transferencia["temporizador"] = temporizador
+            temporizador.start()
+
+    def _cancelar_atrasados(self, id_transferencia):
+        """
+        Se ejecuta cuando un emisor lleva `plazo_transferencia` segundos sin crédito:
+        cancela la transferencia a los destinatarios que la retienen, para que el resto
+        siga recibiéndola. Es el último recurso del control de flujo.
+        """
+        with self.lock_clientes:
+            transferencia = self.transferencias.get(id_transferencia)
+            if transferencia is None:
+                return
+            transferencia["temporizador"] = None
+            destinatarios = transferencia["destinatarios"]
+            if not destinatarios:
+                return
+            enviados = {s: transferencia["enviados"].get(c, 0) for s, c in destinatarios.items()}
+            minimo = min(enviados.values())
+            atrasados = [(s, destinatarios[s]) for s, n in enviados.items() if n == minimo]
+        for socket_destino, conexion in atrasados:
+            self._cancelar_destinatario(id_transferencia, socket_destino, conexion)
+
+    def _cancelar_destinatario(self, id_transferencia, socket_destino, conexion):
+        """
+        Saca a un destinatario lento de una transferencia, descarta sus fragmentos
+        pendientes y le avisa con un transfer_abort. Sin él, el emisor puede recuperar crédito.
+        """
+        with self.lock_clientes:
+            transferencia = self.transferencias.get(id_transferencia)
+            if transferencia:
+                transferencia["destinatarios"].pop(socket_destino, None)
+                self._actualizar_credito(id_transferencia)
+        conexion.descartar_transferencia(id_transferencia)
+        self._enviar(conexion, {"type": "transfer_abort", "id": id_transferencia})
+        self.metricas.incrementar("transferencias_canceladas")
+        logging.info(f'Transferencia {id_transferencia} cancelada para un destinatario lento.')
+
+    def _comprimir(self, payload):
+        """
+        Comprime un payload y apunta en las métricas el tiempo de CPU que ha costado.
+        Devuelve la trama comprimida, o None si no reduce el tamaño.
+        """
+        inicio = time.thread_time()
+        trama = Protocolo.trama_comprimida(payload)
+        self.metricas.incrementar("compresion_cpu_segundos", time.thread_time() - inicio)
+        self.metricas.incrementar("compresion_tramas")
+        return trama
+
+    def _registrar_envio(self, trama_plana, trama):
+        """
+        Contabiliza los bytes enviados y los ahorrados por la compresión.
+        """
+        self.metricas.incrementar("tramas_enviadas")
+        self.metricas.incrementar("bytes_enviados", len(trama))
+        if trama is not trama_plana:
+            self.metricas.incrementar("bytes_ahorrados_compresion", len(trama_plana) - len(trama))
 
     def _eliminar_cliente(self, socket_cliente, nombre_usuario):
         """
         Elimina a un cliente del registro y notifica a los demás sobre su partida.
         """
+        transferencias_cortadas = []
+        suspendida = False
         with self.lock_clientes:
             # Comprobamos si el cliente todavía existe antes de intentar eliminarlo.
-            if socket_cliente in self.clientes:
+            # Si otra conexión reanudó su sesión, ya no está registrado y no hay que anunciar nada.
+            registrado = socket_cliente in self.clientes
+            if registrado:
                 del self.clientes[socket_cliente]
+                self.registrados.discard(socket_cliente)
+                self.cambio_clientes.notify_all()
+                conexion = self.conexiones.pop(socket_cliente, None)
                 try:
-                    socket_cliente.close()
+                    if conexion:
+                        conexion.cerrar()
+                    else:
+                        socket_cliente.close()
                 except:
                     pass # Ignoramos errores al cerrar, puede que ya esté cerrado.
+
+            # Si tenía una sesión reanudable, la suspendemos durante el plazo de gracia
+            # en lugar de anunciar su salida.
+            token = self.tokens.pop(socket_cliente, None)
+            sesion = self.sesiones.get(token)
+            if registrado and sesion is not None and sesion["socket"] is socket_cliente and self.activo:
+                sesion["socket"] = None
+                sesion["temporizador"] = threading.Timer(self.gracia_reanudacion, self._expirar_sesion, args=(token,))
+                sesion["temporizador"].daemon = True
+                sesion["temporizador"].start()
+                suspendida = True
+
+            # Las transferencias que enviaba se cancelan; de las que recibía, se le quita.
+            for id_transferencia, transferencia in list(self.transferencias.items()):
+                if transferencia["emisor"] is socket_cliente:
+                    del self.transferencias[id_transferencia]
+                    if transferencia["temporizador"]:
+                        transferencia["temporizador"].cancel()
+                    transferencias_cortadas.append((id_transferencia, transferencia["destinatarios"]))
+                elif transferencia["destinatarios"].pop(socket_cliente, None):
+                    # Sin él, el emisor puede recuperar el crédito que retenía.
+                    self._actualizar_credito(id_transferencia)
+
+        for id_transferencia, destinatarios in transferencias_cortadas:
+            for conexion in destinatarios.values():
+                conexion.descartar_transferencia(id_transferencia)
+            self._difundir_payload(Protocolo.codificar({"type": "transfer_abort", "id": id_transferencia}),
+                                   list(destinatarios.values()), carril=Conexion.CARRIL_TRANSFERENCIA)
         
-        if nombre_usuario:
+        if nombre_usuario and registrado and not suspendida:
             logging.info(f'{nombre_usuario} ha abandonado el chat.')
             # Notificamos a los clientes restantes que el usuario se ha ido.
             self.broadcast({"type": "leave", "username": nombre_usuario}, socket_cliente)
\ No newline at end of file
@@ -0,0 +1,28 @@
+# tests/conftest.py
+
+import pytest
+
+# We need to adjust the path so pytest can find our application code
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from server import Servidor
+
+
+@pytest.fixture
+def servidor_activo():
+    """
+    Esta fixture inicia el servidor antes de cada prueba y se asegura
+    de detenerlo después, incluso si la prueba falla.
+    """
+    # Port 0 lets the OS pick a free port, so several test runs can share the machine.
+    servidor = Servidor('127.0.0.1', 0)
+    servidor.iniciar()
+    assert servidor.listo.wait(timeout=5)
+
+    # 'yield' passes control to the test function
+    yield servidor
+
+    # This code runs after the test is complete
+    servidor.detener()
@@ -0,0 +1,181 @@
+# tests/test_async_client.py
+
+import asyncio
+import pytest
+from unittest.mock import Mock
+
+# We need to adjust the path so pytest can find our application code
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from async_client import ClienteAsync, PoolClientes
+from protocol import Protocolo
+
+
+async def _siguiente_texto(cliente):
+    """
+    Devuelve el siguiente mensaje de chat, saltándose avisos como 'join' o 'leave'.
+    """
+    async for mensaje in cliente:
+        if mensaje.get("type") == "message":
+            return mensaje
+
+
+def test_envios_encadenados_llegan_en_orden(servidor_activo):
+    """
+    Verifica que el cliente asíncrono hace el saludo por su cuenta y que muchos
+    envíos seguidos, sin esperar respuesta, llegan completos y en orden.
+    """
+    host, port = servidor_activo.direccion
+
+    async def escenario():
+        async with ClienteAsync("Alice", host, port) as alice, ClienteAsync("Bob", host, port) as bob:
+            assert alice.token_sesion is not None
+
+            for i in range(500):
+                await alice.enviar(f"mensaje {i}")
+
+            textos = [(await asyncio.wait_for(_siguiente_texto(bob), 2.0)).get("text") for _ in range(500)]
+            assert textos == [f"mensaje {i}" for i in range(500)]
+
+    asyncio.run(escenario())
+
+
+def test_cliente_reanuda_la_sesion_tras_un_corte(servidor_activo):
+    """
+    Verifica que, si se corta la conexión, el cliente reconecta solo y reanuda su sesión,
+    así que los demás no ven un 'leave' y recibe lo que se envió mientras tanto.
+    """
+    host, port = servidor_activo.direccion
+
+    async def escenario():
+        async with ClienteAsync("Alice", host, port, gracia_reconexion=5.0) as alice, \
+                ClienteAsync("Bob", host, port) as bob:
+            token = alice.token_sesion
+            # Cortamos la conexión de Alice desde el servidor.
+            with servidor_activo.lock_clientes:
+                conexion = next(c for s, c in servidor_activo.conexiones.items() if servidor_activo.clientes.get(s) == "Alice")
+            conexion.cerrar()
+
+            await bob.enviar("¿sigues ahí?")
+            mensaje = await asyncio.wait_for(_siguiente_texto(alice), 5.0)
+            assert mensaje.get("text") == "¿sigues ahí?"
+            assert alice.token_sesion == token
+
+    asyncio.run(escenario())
+
+
+def test_pool_reparte_muchos_bots_en_pocos_hilos(servidor_activo):
+    """
+    Verifica que el pool conecta varios bots en dos bucles de eventos y que
+    el mensaje de uno llega a todos los demás.
+    """
+    host, port = servidor_activo.direccion
+
+    with PoolClientes(hilos=2) as pool:
+        bots = [pool.lanzar(ClienteAsync(f"bot{i}", host, port).conectar()).result(timeout=5)
+                for i in range(4)]
+        assert len({bot.bucle for bot in bots}) == 2
+
+        pool.lanzar(bots[0].enviar("hola a todos"), cliente=bots[0]).result(timeout=5)
+        for bot in bots[1:]:
+            mensaje = pool.lanzar(_siguiente_texto(bot), cliente=bot).result(timeout=5)
+            assert mensaje.get("username") == "bot0" and mensaje.get("text") == "hola a todos"
+
+        for bot in bots:
+            pool.lanzar(bot.cerrar(), cliente=bot).result(timeout=5)
+
+
+def test_reanudar_no_adelanta_la_ultima_secuencia_recibida():
+    """
+    Verifica que el `seq` de un 'session' reanudado (el último del servidor) no
+    cuenta como recibido: si la conexión cae a mitad del reenvío, la siguiente
+    reanudación debe pedir desde el último mensaje que sí llegó.
+    """
+    cliente = ClienteAsync("Alice")
+    cliente.ultima_secuencia = 5
+    # La conexión cae justo después del 'session', antes de recibir los mensajes 6 a 10.
+    entrantes = iter([
+        {"type": "session", "resume_token": "t", "seq": 10, "resumed": True},
+        None,
+    ])
+
+    async def recibir():
+        return next(entrantes)
+
+    async def escenario():
+        cliente._mensajes = asyncio.Queue()
+        cliente._registrado = asyncio.Event()
+        cliente._recibir = recibir
+        await cliente._bucle_lectura()
+
+    asyncio.run(escenario())
+    assert cliente.ultima_secuencia == 5
+
+
+def test_sin_sesion_el_registro_se_confirma_con_el_pong_del_latido():
+    """
+    Verifica que, sin sesión reanudable, contestar al saludo no basta para darse
+    por registrado: el cliente envía un latido y espera a su 'pong'.
+    """
+    cliente = ClienteAsync("Alice", reanudar=False)
+    cliente._writer = Mock()
+    registrado = []
+    entrantes = iter([
+        {"type": "username_request"},
+        {"type": "pong", "id": ClienteAsync._ID_REGISTRO},
+        None,
+    ])
+
+    async def recibir():
+        registrado.append(cliente._registrado.is_set())
+        return next(entrantes)
+
+    async def escenario():
+        cliente._mensajes = asyncio.Queue()
+        cliente._registrado = asyncio.Event()
+        cliente._recibir = recibir
+        await cliente._bucle_lectura()
+
+    asyncio.run(escenario())
+    # Antes del 'username_request', tras contestarlo y, por fin, tras el 'pong'.
+    assert registrado == [False, False, True]
+    enviados = [Protocolo.decodificar(c[0][0][4:]) for c in cliente._writer.write.call_args_list]
+    assert enviados[-1] == {"type": "ping", "id": ClienteAsync._ID_REGISTRO}
+
+
+def test_conectar_falla_si_el_servidor_no_registra_al_cliente(servidor_activo):
+    """
+    Verifica que, si el servidor rechaza el nombre de usuario y cierra la conexión,
+    `conectar` lanza ConnectionError en lugar de devolver un cliente muerto.
+    """
+    host, port = servidor_activo.direccion
+
+    async def escenario():
+        for reanudar in (True, False):
+            with pytest.raises(ConnectionError):
+                await ClienteAsync("   ", host, port, reanudar=reanudar).conectar()
+
+    asyncio.run(escenario())
+
+
+def test_recibir_rechaza_tramas_comprimidas_si_no_se_negocio():
+    """
+    Verifica que el cliente, como el servidor, no descomprime tramas comprimidas
+    si no negoció la compresión.
+    """
+    cliente = ClienteAsync("Alice")
+    trama = Protocolo.trama_comprimida(Protocolo.codificar({"type": "message", "text": "x" * 2000}))
+
+    async def escenario():
+        cliente._reader = asyncio.StreamReader()
+        cliente._reader.feed_data(trama * 2)
+        cliente.compresion_negociada = True
+        aceptada = await cliente._recibir()
+        cliente.compresion_negociada = False
+        return aceptada, await cliente._recibir()
+
+    aceptada, rechazada = asyncio.run(escenario())
+    assert aceptada == {"type": "message", "text": "x" * 2000}
+    assert rechazada is None
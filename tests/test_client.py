@@ -0,0 +1,59 @@
+# tests/test_client.py
+
+import pytest
+import socket
+import threading
+import time
+
+# We need to adjust the path so pytest can find our application code
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from client import Cliente
+from protocol import Protocolo
+
+
+def test_los_envios_esperan_a_que_se_conteste_el_saludo():
+    """
+    Verifica que un mensaje escrito antes de contestar al `username_request`
+    (p. ej. durante una reconexión) sale después de la respuesta al saludo,
+    y no en su lugar.
+    """
+    # 1. Arrange
+    cliente = Cliente()
+    cliente.nombre_usuario = "Alice"
+    extremo_cliente, extremo_servidor = socket.socketpair()
+    cliente.socket_cliente = extremo_cliente
+    envio = threading.Thread(target=cliente._enviar, args=({"type": "message", "text": "hola"},))
+    envio.start()
+    time.sleep(0.1)
+
+    # 2. Act
+    threading.Thread(target=cliente._bucle_recibir, daemon=True).start()
+    Protocolo.enviar(extremo_servidor, {"type": "username_request"})
+
+    # 3. Assert
+    try:
+        assert Protocolo.recibir(extremo_servidor).get("username") == "Alice"
+        assert Protocolo.recibir(extremo_servidor) == {"type": "message", "text": "hola"}
+        envio.join(timeout=1)
+    finally:
+        cliente.activo = False
+        extremo_servidor.close()
+        extremo_cliente.close()
+
+
+def test_un_envio_en_espera_falla_si_el_cliente_se_detiene():
+    """
+    Verifica que un envío que espera al saludo no se queda bloqueado para siempre
+    si el cliente se detiene (p. ej. porque no pudo reconectar).
+    """
+    cliente = Cliente()
+    cliente.socket_cliente = socket.socket()
+    cliente.activo = False
+    try:
+        with pytest.raises(ConnectionError):
+            cliente._enviar({"type": "message", "text": "hola"})
+    finally:
+        cliente.socket_cliente.close()
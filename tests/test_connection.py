@@ -0,0 +1,197 @@
+# tests/test_connection.py
+
+import threading
+import pytest
+from unittest.mock import Mock
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from connection import Conexion
+from metrics import Metricas
+
+
+def test_escritor_envia_las_tramas_en_orden():
+    """
+    PRUEBA POSITIVA:
+    Las tramas encoladas se envían por el socket en el mismo orden.
+    """
+    # 1. Preparación
+    mock_socket = Mock()
+    enviadas = []
+    terminado = threading.Event()
+
+    def sendall(trama):
+        enviadas.append(trama)
+        if len(enviadas) == 3:
+            terminado.set()
+
+    mock_socket.sendall.side_effect = sendall
+    conexion = Conexion(mock_socket)
+    conexion.iniciar()
+
+    # 2. Actuación
+    for trama in (b"uno", b"dos", b"tres"):
+        conexion.encolar(trama)
+
+    # 3. Aserción
+    assert terminado.wait(timeout=1)
+    assert enviadas == [b"uno", b"dos", b"tres"]
+    conexion.cerrar()
+
+
+def test_ventana_de_transferencia_limita_lo_pendiente():
+    """
+    PRUEBA NEGATIVA:
+    Si el socket no avanza, los bytes pendientes de cada transferencia se
+    contabilizan por separado y se liberan al descartarla.
+    """
+    # 1. Preparación: el escritor no se arranca, así que nada sale de la cola.
+    conexion = Conexion(Mock())
+    conexion.encolar(b"x" * 100, "t1")
+
+    # 2. Actuación y 3. Aserción
+    assert conexion.pendiente("t1") == 100
+    assert conexion.pendiente("t2") == 0
+
+    conexion.encolar(b"y" * 10)
+    assert conexion.pendiente() == 110
+
+    conexion.descartar_transferencia("t1")
+    assert conexion.pendiente("t1") == 0
+    assert conexion.pendiente() == 10
+
+
+def test_escritor_avisa_de_cada_trama_de_transferencia_enviada():
+    """
+    PRUEBA POSITIVA:
+    Tras enviar una trama de una transferencia, el escritor llama a `al_enviar`
+    con la conexión y el identificador; las demás tramas no avisan.
+    """
+    # 1. Preparación
+    avisos = []
+    terminado = threading.Event()
+
+    def al_enviar(conexion, transferencia):
+        avisos.append((conexion, transferencia))
+        terminado.set()
+
+    conexion = Conexion(Mock(), al_enviar=al_enviar)
+    conexion.encolar(b"chat")
+    conexion.encolar(b"fragmento", "t1")
+
+    # 2. Actuación
+    conexion.iniciar()
+
+    # 3. Aserción
+    assert terminado.wait(timeout=1)
+    assert conexion.drenar(timeout=1)
+    assert avisos == [(conexion, "t1")]
+    assert conexion.pendiente() == 0
+    conexion.cerrar()
+
+
+def _orden_de_salida(conexion):
+    """
+    Vacía la conexión sin socket, eligiendo las tramas como lo haría el escritor.
+    """
+    salida = []
+    with conexion._condicion:
+        while conexion._hay_pendientes():
+            salida.append(conexion._siguiente()[0])
+    return salida
+
+
+def test_control_sale_primero_y_la_despedida_al_final():
+    """
+    PRUEBA POSITIVA:
+    Una trama de control adelanta al chat y a las transferencias ya encolados,
+    y la despedida solo sale cuando no queda nada más.
+    """
+    # 1. Preparación: el escritor no se arranca, así que todo se queda en cola.
+    conexion = Conexion(Mock())
+    conexion.encolar(b"fragmento", "t1")
+    conexion.encolar(b"chat")
+    conexion.encolar_despedida(b"reconnect")
+    conexion.encolar(b"pong", carril=Conexion.CARRIL_CONTROL)
+
+    # 2. Actuación
+    salida = _orden_de_salida(conexion)
+
+    # 3. Aserción
+    assert salida[0] == b"pong"
+    assert set(salida[1:3]) == {b"fragmento", b"chat"}
+    assert salida[3] == b"reconnect"
+
+
+def test_chat_y_transferencias_se_reparten_segun_sus_pesos():
+    """
+    PRUEBA POSITIVA:
+    Con los dos carriles llenos, cada uno envía en proporción a su peso y
+    dentro de cada carril se respeta el orden.
+    """
+    # 1. Preparación
+    conexion = Conexion(Mock(), pesos={Conexion.CARRIL_CHAT: 3, Conexion.CARRIL_TRANSFERENCIA: 1})
+    conexion.CUANTO = 10
+    for i in range(6):
+        conexion.encolar(b"c%09d" % i)
+        conexion.encolar(b"t%09d" % i, "t1")
+
+    # 2. Actuación
+    salida = _orden_de_salida(conexion)[:8]
+
+    # 3. Aserción
+    assert [t[:1] for t in salida] == [b"c", b"c", b"c", b"t", b"c", b"c", b"c", b"t"]
+    assert [t for t in salida if t[:1] == b"t"] == [b"t000000000", b"t000000001"]
+
+
+def test_pesos_parciales_se_completan_con_los_de_por_defecto():
+    """
+    PRUEBA POSITIVA:
+    Si solo se indica el peso de un carril, el resto usa el de `PESOS` y
+    sus tramas siguen saliendo.
+    """
+    conexion = Conexion(Mock(), pesos={Conexion.CARRIL_CHAT: 2})
+    conexion.encolar(b"transferencia", "t1")
+
+    assert _orden_de_salida(conexion) == [b"transferencia"]
+
+
+@pytest.mark.parametrize("pesos", [
+    {Conexion.CARRIL_CHAT: 0},
+    {Conexion.CARRIL_TRANSFERENCIA: -1},
+    {Conexion.CARRIL_CHAT: 1.5},
+    {Conexion.CARRIL_CHAT: True},
+    {Conexion.CARRIL_CONTROL: 1},
+])
+def test_pesos_no_validos_se_rechazan(pesos):
+    """
+    PRUEBA NEGATIVA:
+    Un peso que no es un entero positivo, o de un carril que no se reparte,
+    se rechaza al crear la conexión en vez de bloquear al escritor.
+    """
+    with pytest.raises(ValueError):
+        Conexion(Mock(), pesos=pesos)
+
+def test_escritor_mide_la_espera_en_cola_de_cada_carril():
+    """
+    PRUEBA POSITIVA:
+    El escritor apunta en las métricas cuántas tramas salen por cada carril
+    y cuánto tiempo esperaron en la cola.
+    """
+    # 1. Preparación
+    metricas = Metricas()
+    conexion = Conexion(Mock(), metricas=metricas)
+    conexion.encolar(b"chat")
+    conexion.encolar(b"stats", carril=Conexion.CARRIL_CONTROL)
+
+    # 2. Actuación
+    conexion.iniciar()
+    assert conexion.drenar(timeout=1)
+
+    # 3. Aserción
+    valores = metricas.instantanea()
+    assert valores["cola_chat_tramas"] == 1 and valores["cola_control_tramas"] == 1
+    assert valores["cola_chat_espera_max_segundos"] >= 0
+    assert valores["cola_chat_espera_segundos"] >= 0
+    conexion.cerrar()
@@ -1,6 +1,6 @@
 # tests/test_integration_chat.py
 
-import pytest
+import base64
 import socket
 import threading
 import time
@@ -13,6 +13,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 from server import Servidor
 from protocol import Protocolo
+from client import Cliente
 
 # Clase auxiliar para ejecutar un cliente en un hilo separado.
 # Esto es FUNDAMENTAL para probar un servidor sin bloquear el hilo de prueba principal..
@@ -21,9 +22,17 @@ class TestClient:
     Un cliente de ayuda que encapsula la comunicaciÃ³n de red en un hilo separado,
     evitando que el hilo principal de la prueba se bloquee.
     """
-    def __init__(self, host, port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((host, port))
+    # No es una clase de pruebas, aunque su nombre empiece por "Test".
+    __test__ = False
+    # Texto con el que `sincronizar` reconoce el final de la barrera.
+    MARCA_BARRERA = "__barrera__"
+
+    def __init__(self, host=None, port=None, sock=None):
+        # Si se pasa un socket ya conectado (Unix o socketpair), se usa tal cual.
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((host, port))
+        self.sock = sock
         self.mensajes = Queue() # A thread-safe queue to store received messages
         self.activo = True
         self.hilo_escucha = threading.Thread(target=self._escuchar, daemon=True)
@@ -62,41 +71,57 @@ class TestClient:
         except Empty:
             return None
 
+    def esperar_tipo(self, tipo, timeout=1.0):
+        """
+        Devuelve el siguiente mensaje del tipo indicado, saltándose los demás
+        (por ejemplo, los 'join' de clientes que se registraron en otro orden).
+        """
+        while True:
+            msg = self.obtener_mensaje(timeout)
+            if msg is None or msg.get("type") == tipo:
+                return msg
+
+    def sincronizar(self, testigo):
+        """
+        Hace que `testigo`, otro cliente registrado, envíe una marca de chat y devuelve
+        todo lo recibido antes de ella. Los mensajes difundidos se numeran y viajan por
+        el mismo carril que la marca, así que ninguno difundido antes puede llegar después.
+        Lo que difunda el hilo de otra conexión solo queda cubierto si `testigo` ya lo recibió.
+        """
+        testigo.enviar_texto(self.MARCA_BARRERA)
+        descartados = []
+        while True:
+            msg = self.obtener_mensaje()
+            assert msg is not None, "La marca de la barrera no llegó."
+            if msg.get("type") == "message" and msg.get("text") == self.MARCA_BARRERA:
+                return descartados
+            descartados.append(msg)
+
     def cerrar(self):
         self.activo = False
+        # `shutdown` despierta al hilo que está bloqueado en `recv`; `close` solo no lo hace.
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
         self.hilo_escucha.join()
 
-@pytest.fixture
-def servidor_activo():
-    """
-    Esta fixture inicia el servidor antes de cada prueba y se asegura
-    de detenerlo despuÃ©s, incluso si la prueba falla.
-    """
-    servidor = Servidor('127.0.0.1', 55555)
-    servidor.iniciar()
-    # Wait a moment for the server thread to start listening
-    time.sleep(0.1)
-
-    # 'yield' passes control to the test function
-    yield servidor.host, servidor.port
-
-    # This code runs after the test is complete
-    servidor.detener()
-
 
 def test_multiples_conexiones_y_broadcast(servidor_activo):
     """
     Verifica que mÃºltiples clientes pueden conectarse y que un mensaje
     enviado por uno es recibido por el otro.
     """
-    host, port = servidor_activo
+    host, port = servidor_activo.direccion
     alice = TestClient(host, port)
     bob = TestClient(host, port)
 
     # Alice authenticates
     assert alice.obtener_mensaje().get("type") == "username_request"
     alice.enviar({"username": "Alice"})
+    # Bob must register after Alice for her to see his 'join'
+    assert servidor_activo.esperar_clientes(1, timeout=5)
 
     # Bob authenticates
     assert bob.obtener_mensaje().get("type") == "username_request"
@@ -125,7 +150,7 @@ def test_manejo_de_desconexion_inesperada(servidor_activo):
     Verifica que el servidor maneja la desconexiÃ³n abrupta de un cliente
     sin caerse y notifica correctamente a los demÃ¡s.
     """
-    host, port = servidor_activo
+    host, port = servidor_activo.direccion
     alice = TestClient(host, port)
     bob = TestClient(host, port)
     charlie = TestClient(host, port)
@@ -138,19 +163,15 @@ def test_manejo_de_desconexion_inesperada(servidor_activo):
     charlie.obtener_mensaje()
     charlie.enviar({"username": "Charlie"})
 
-    # Clear initial join messages
-    time.sleep(0.1)
-    while alice.obtener_mensaje(timeout=0.01) is not None: 
-        pass
-    while bob.obtener_mensaje(timeout=0.01) is not None: 
-        pass
+    # Wait until everyone is registered
+    assert servidor_activo.esperar_clientes(3, timeout=5)
 
     # Charlie disconnects abruptly
     charlie.cerrar()
 
-    # Alice and Bob should receive a "leave" notification
-    msg_leave_alice = alice.obtener_mensaje(timeout=1)
-    msg_leave_bob = bob.obtener_mensaje(timeout=1)
+    # Alice and Bob should receive a "leave" notification (skipping the initial joins)
+    msg_leave_alice = alice.esperar_tipo("leave")
+    msg_leave_bob = bob.esperar_tipo("leave")
 
     assert msg_leave_alice is not None, "Alice no recibiÃ³ la notificaciÃ³n de 'leave'."
     assert msg_leave_alice.get("type") == "leave" and msg_leave_alice.get("username") == "Charlie"
@@ -160,7 +181,7 @@ def test_manejo_de_desconexion_inesperada(servidor_activo):
 
     # Alice sends a message to ensure the chat is still operational
     alice.enviar_texto("El chat sigue operativo")
-    mensaje_final = bob.obtener_mensaje(timeout=1)
+    mensaje_final = bob.esperar_tipo("message")
 
     assert mensaje_final is not None, "Bob no recibiÃ³ el mensaje final de Alice."
     assert mensaje_final.get("text") == "El chat sigue operativo"
@@ -177,7 +198,7 @@ def test_mensajes_no_se_pierden_ni_duplican_bajo_carga(servidor_activo):
     se pierden ni se desordenan los mensajes.
     """
     # 1. Arrange
-    host, port = servidor_activo
+    host, port = servidor_activo.direccion
     emisor = TestClient(host, port)
     receptor = TestClient(host, port)
 
@@ -187,10 +208,8 @@ def test_mensajes_no_se_pierden_ni_duplican_bajo_carga(servidor_activo):
     receptor.obtener_mensaje()
     receptor.enviar({"username": "Receptor"})
 
-    # Clear the join notifications from the queue to not interfere with the test
-    time.sleep(0.1)
-    while receptor.obtener_mensaje(timeout=0.01) is not None: 
-        pass
+    # Both must be registered before sending, or the first messages have no receiver
+    assert servidor_activo.esperar_clientes(2, timeout=5)
 
     # 2. Act
     mensajes_enviados = []
@@ -203,8 +222,9 @@ def test_mensajes_no_se_pierden_ni_duplican_bajo_carga(servidor_activo):
     mensajes_recibidos = []
     # Try to receive all 50 messages
     for _ in range(50):
-        msg = receptor.obtener_mensaje(timeout=2) # Use a generous timeout
-        if msg and msg.get("type") == "message":
+        # Skip the join notification, if the receiver registered first
+        msg = receptor.esperar_tipo("message")
+        if msg:
             mensajes_recibidos.append(msg.get("text"))
 
     # The final, critical assertion. The lists must be identical.
@@ -222,13 +242,19 @@ def test_servidor_maneja_cliente_sin_autenticacion(servidor_activo):
     al cliente silenciosamente sin afectar a los demÃ¡s.
     """
     # 1. Arrange
-    host, port = servidor_activo
+    host, port = servidor_activo.direccion
     cliente_bueno = TestClient(host, port)
     cliente_malo = TestClient(host, port) # This client will not authenticate
+    testigo = TestClient(host, port) # Solo sirve para la barrera del final
 
     # El cliente bueno se autentica y opera normalmente
     cliente_bueno.obtener_mensaje()
     cliente_bueno.enviar({"username": "ClienteBueno"})
+    assert servidor_activo.esperar_clientes(1, timeout=5)
+    testigo.obtener_mensaje()
+    testigo.enviar({"username": "Testigo"})
+    # El testigo tiene que estar registrado antes del mensaje para poder verlo.
+    assert servidor_activo.esperar_clientes(2, timeout=5)
 
     # El cliente malo recibe la peticiÃ³n de username, pero la ignora.
     msg_req = cliente_malo.obtener_mensaje()
@@ -240,13 +266,286 @@ def test_servidor_maneja_cliente_sin_autenticacion(servidor_activo):
 
     # 3. Assert
     # El cliente bueno NO deberÃ­a recibir NADA. Ni su propio mensaje, ni
-    # notificaciones del cliente malo. Usamos un timeout corto.
-    mensaje_inesperado = cliente_bueno.obtener_mensaje(timeout=0.5)
-    assert mensaje_inesperado is None, "El cliente bueno recibiÃ³ un mensaje inesperado."
+    # notificaciones del cliente malo. Cuando el testigo ha visto el mensaje ya se
+    # ha difundido, así que la barrera cubre un posible eco sin tener que esperar.
+    mensaje = testigo.esperar_tipo("message")
+    assert mensaje is not None and mensaje.get("text") == "Â¿Hay alguien ahÃ­?"
+    mensajes_inesperados = [m for m in cliente_bueno.sincronizar(testigo)
+                            if (m.get("type"), m.get("username")) != ("join", "Testigo")]
+    assert mensajes_inesperados == [], "El cliente bueno recibiÃ³ un mensaje inesperado."
 
     # Cleanup
     cliente_bueno.cerrar()
     cliente_malo.cerrar()
+    testigo.cerrar()
+
+
+def test_transferencia_por_fragmentos_se_intercala_con_el_chat(servidor_activo):
+    """
+    Verifica que una transferencia por fragmentos llega completa y en orden,
+    y que un mensaje de chat enviado a mitad de la transferencia también llega.
+    """
+    # 1. Arrange
+    host, port = servidor_activo.direccion
+    alice = TestClient(host, port)
+    bob = TestClient(host, port)
+    alice.obtener_mensaje()
+    alice.enviar({"username": "Alice"})
+    assert servidor_activo.esperar_clientes(1, timeout=5)
+    bob.obtener_mensaje()
+    bob.enviar({"username": "Bob"})
+    assert alice.obtener_mensaje().get("type") == "join"
+
+    # 2. Act
+    alice.enviar({"type": "transfer_start", "id": "t1", "name": "log.txt", "size": 6})
+    alice.enviar({"type": "transfer_chunk", "id": "t1", "data": "aG9s"})
+    alice.enviar_texto("mientras tanto")
+    alice.enviar({"type": "transfer_chunk", "id": "t1", "data": "YSE="})
+    alice.enviar({"type": "transfer_end", "id": "t1"})
+
+    # 3. Assert
+    recibidos = [bob.obtener_mensaje() for _ in range(5)]
+    # El chat y las transferencias van por carriles distintos: el mensaje puede
+    # adelantar a los fragmentos, pero la transferencia conserva su orden.
+    transferencia = [m for m in recibidos if m.get("type") != "message"]
+    assert [m.get("type") for m in transferencia] == [
+        "transfer_start", "transfer_chunk", "transfer_chunk", "transfer_end"
+    ]
+    assert transferencia[0].get("username") == "Alice"
+    assert [transferencia[1].get("data"), transferencia[2].get("data")] == ["aG9s", "YSE="]
+    assert [m.get("text") for m in recibidos if m.get("type") == "message"] == ["mientras tanto"]
+
+    # Cleanup
+    alice.cerrar()
+    bob.cerrar()
+
+
+def test_destinatario_que_no_lee_no_retrasa_el_chat_del_emisor(servidor_activo):
+    """
+    Verifica que un destinatario que nunca lee no bloquea al emisor: mientras se
+    le cancela la transferencia, el chat que el emisor envía detrás de los
+    fragmentos sigue llegando enseguida a los demás.
+    """
+    # 1. Arrange
+    host, port = servidor_activo.direccion
+    # Una ventana pequeña hace que al dormido se le llene enseguida.
+    servidor_activo.ventana_transferencia = 256 * 1024
+    alice = TestClient(host, port)
+    alice.obtener_mensaje()
+    alice.enviar({"username": "Alice"})
+    observador = TestClient(host, port)
+    observador.obtener_mensaje()
+    observador.enviar({"username": "Observador"})
+    # Un cliente que se registra y no vuelve a leer nada de su socket.
+    dormido = socket.create_connection((host, port))
+    Protocolo.recibir(dormido)
+    Protocolo.enviar(dormido, {"username": "Dormido"})
+    assert servidor_activo.esperar_clientes(3, timeout=5)
+
+    # 2. Act
+    datos = base64.b64encode(b"x" * Protocolo.TAMAÑO_FRAGMENTO).decode('ascii')
+    alice.enviar({"type": "transfer_start", "id": "t1", "name": "grande.bin", "size": 150 * Protocolo.TAMAÑO_FRAGMENTO})
+    for _ in range(150):
+        alice.enviar({"type": "transfer_chunk", "id": "t1", "data": datos})
+    inicio = time.monotonic()
+    alice.enviar_texto("hola")
+
+    # 3. Assert
+    mensaje = observador.esperar_tipo("message", timeout=5)
+    assert mensaje is not None and mensaje.get("text") == "hola"
+    assert time.monotonic() - inicio < 1.0
+    assert servidor_activo.metricas.obtener("transferencias_canceladas") >= 1
+
+    # Cleanup
+    dormido.close()
+    alice.cerrar()
+    observador.cerrar()
+
+
+
+def test_emisor_con_credito_espera_al_destinatario_lento(servidor_activo, tmp_path):
+    """
+    Verifica que un cliente que envía un archivo solo adelanta los fragmentos para
+    los que tiene crédito: mientras el destinatario no lee, la cola del servidor
+    hacia él no crece, y cuando empieza a leer recibe el archivo entero sin cancelaciones.
+    """
+    # 1. Arrange
+    host, port = servidor_activo.direccion
+    lento = socket.create_connection((host, port))
+    Protocolo.recibir(lento)
+    Protocolo.enviar(lento, {"username": "Lento"})
+    assert servidor_activo.esperar_clientes(1, timeout=5)
+    alice = Cliente(host, port, directorio_descargas=str(tmp_path / "descargas"))
+    alice.nombre_usuario = "Alice"
+    alice._conectar()
+    threading.Thread(target=alice._bucle_recibir, daemon=True).start()
+    assert servidor_activo.esperar_clientes(2, timeout=5)
+    with servidor_activo.lock_clientes:
+        conexion_lenta = next(c for s, c in servidor_activo.conexiones.items()
+                              if servidor_activo.clientes.get(s) == "Lento")
+
+    # Más grande que lo que cabe en los búferes del sistema, para que el crédito se note.
+    fragmentos = 300
+    ruta = tmp_path / "grande.bin"
+    ruta.write_bytes(b"x" * (fragmentos * Protocolo.TAMAÑO_FRAGMENTO))
+
+    # 2. Act
+    envio = threading.Thread(target=alice._enviar_archivo, args=(str(ruta),), daemon=True)
+    envio.start()
+    time.sleep(0.5)
+
+    # 3. Assert: el emisor está esperando crédito y la cola hacia el lento está acotada.
+    assert envio.is_alive()
+    tamaño_trama = len(Protocolo.trama(Protocolo.codificar({
+        "type": "transfer_chunk", "id": "x" * 32,
+        "data": base64.b64encode(b"x" * Protocolo.TAMAÑO_FRAGMENTO).decode('ascii')
+    })))
+    assert conexion_lenta.pendiente() <= (servidor_activo.credito_transferencia + 1) * tamaño_trama
+
+    # Cuando el lento lee, el envío avanza hasta el final.
+    recibidos = 0
+    while True:
+        mensaje = Protocolo.recibir(lento)
+        if mensaje.get("type") == "transfer_chunk":
+            recibidos += 1
+        elif mensaje.get("type") == "transfer_end":
+            break
+    envio.join(timeout=5)
+    assert not envio.is_alive()
+    assert recibidos == fragmentos
+    assert servidor_activo.metricas.obtener("transferencias_canceladas") == 0
+
+    # Cleanup
+    alice.activo = False
+    alice.socket_cliente.close()
+    lento.close()
+
+def test_reanudar_sesion_recupera_mensajes_sin_join_ni_leave(servidor_activo):
+    """
+    Verifica que un cliente que se reconecta con su token de sesión recibe
+    los mensajes que se perdió y que los demás no ven ni 'leave' ni 'join'.
+    """
+    # 1. Arrange
+    host, port = servidor_activo.direccion
+    alice = TestClient(host, port)
+    alice.obtener_mensaje()
+    alice.enviar({"username": "Alice", "resume": True})
+    sesion = alice.obtener_mensaje()
+    assert sesion.get("type") == "session" and sesion.get("resumed") is False
+
+    bob = TestClient(host, port)
+    bob.obtener_mensaje()
+    bob.enviar({"username": "Bob"})
+    join_bob = alice.obtener_mensaje()
+    assert join_bob.get("type") == "join"
+
+    # 2. Act: Alice pierde la conexión y Bob escribe mientras tanto.
+    alice.cerrar()
+    bob.enviar_texto("te lo perdiste")
+
+    alice = TestClient(host, port)
+    alice.obtener_mensaje()
+    alice.enviar({"username": "Alice", "resume_token": sesion["resume_token"], "last_seq": join_bob["seq"]})
+
+    # 3. Assert
+    reanudada = alice.obtener_mensaje()
+    assert reanudada.get("type") == "session" and reanudada.get("resumed") is True
+    perdido = alice.obtener_mensaje()
+    assert perdido.get("text") == "te lo perdiste" and perdido.get("seq") > join_bob["seq"]
+
+    # Alice, ya reanudada, hace de testigo: un 'leave' o un 'join' suyo llegaría a Bob antes que su marca.
+    assert bob.sincronizar(alice) == []
+
+    # Cleanup
+    alice.cerrar()
+    bob.cerrar()
+
+
+def test_reinicio_sin_cortes_traspasa_el_socket_y_las_sesiones(tmp_path):
+    """
+    Verifica que un servidor nuevo hereda el socket de escucha del anterior:
+    los clientes reciben el aviso 'reconnect', se reconectan al mismo puerto
+    y reanudan su sesión en el proceso nuevo, donde se anuncia la salida de
+    quien no tenía sesión.
+    """
+    # 1. Arrange
+    ruta = str(tmp_path / "traspaso.sock")
+    anterior = Servidor('127.0.0.1', 0, ruta_traspaso=ruta, plazo_drenaje=1.0)
+    anterior.iniciar()
+    host, port = anterior.direccion
+
+    alice = TestClient(host, port)
+    alice.obtener_mensaje()
+    alice.enviar({"username": "Alice", "resume": True})
+    sesion = alice.obtener_mensaje()
+    # Bob no pide sesión, así que no podrá seguir en el proceso nuevo.
+    bob = TestClient(host, port)
+    bob.obtener_mensaje()
+    bob.enviar({"username": "Bob"})
+    join_bob = alice.obtener_mensaje()
+    assert join_bob.get("type") == "join"
+
+    # 2. Act
+    nuevo = Servidor('127.0.0.1', 0)
+    nuevo.iniciar(heredar_de=ruta)
+
+    # 3. Assert
+    assert alice.obtener_mensaje().get("type") == "reconnect"
+    alice.cerrar()
+    anterior.detener()
+    bob.cerrar()
+
+    alice = TestClient(host, port)
+    alice.obtener_mensaje()
+    alice.enviar({"username": "Alice", "resume_token": sesion["resume_token"], "last_seq": join_bob["seq"]})
+    reanudada = alice.obtener_mensaje()
+    assert reanudada.get("type") == "session" and reanudada.get("resumed") is True
+    salida = alice.obtener_mensaje()
+    assert salida.get("type") == "leave" and salida.get("username") == "Bob"
+    assert anterior.metricas.obtener("mensajes_descartados_traspaso") == 0
+
+    # Cleanup
+    alice.cerrar()
+    nuevo.detener()
+
+
+def test_clientes_tcp_unix_y_locales_conversan_entre_si(tmp_path):
+    """
+    Verifica que los tres transportes (TCP, socket Unix y socketpair en el mismo
+    proceso) hablan el mismo protocolo y comparten la misma sala.
+    """
+    # 1. Arrange
+    ruta_unix = str(tmp_path / "chat.sock")
+    servidor = Servidor('127.0.0.1', 0, ruta_unix=ruta_unix)
+    servidor.iniciar()
+    host, port = servidor.direccion
+
+    socket_unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    socket_unix.connect(ruta_unix)
+    clientes = {
+        "Tcp": TestClient(host, port),
+        "Unix": TestClient(sock=socket_unix),
+        "Local": TestClient(sock=servidor.conectar_local()),
+    }
+    for nombre, cliente in clientes.items():
+        assert cliente.obtener_mensaje().get("type") == "username_request"
+        cliente.enviar({"username": nombre})
+    assert servidor.esperar_clientes(3, timeout=5)
+
+    # 2. Act
+    clientes["Local"].enviar_texto("hola desde dentro")
+
+    # 3. Assert
+    for nombre in ("Tcp", "Unix"):
+        # Antes pueden llegar los 'join' de quienes se registraron después.
+        mensaje = clientes[nombre].esperar_tipo("message")
+        assert mensaje.get("username") == "Local" and mensaje.get("text") == "hola desde dentro"
+
+    # Cleanup
+    for cliente in clientes.values():
+        cliente.cerrar()
+    servidor.detener()
+    assert not os.path.exists(ruta_unix)
 
 
 # python -m pytest --cov=server --cov=protocol --cov-report term-missing
@@ -1,5 +1,6 @@
 # tests/test_protocol.py
 
+import io
 import json
 import struct
 from unittest.mock import Mock # Nuestra herramienta para simular objetos
@@ -84,3 +85,100 @@ def test_recibir_devuelve_none_si_el_socket_se_cierra():
     # 3. Aserción
     # Esperamos que la función devuelva None para indicar una desconexión.
     assert resultado is None
+
+# --- Pruebas para la compresión negociada ---
+
+def test_enviar_comprime_payloads_grandes_si_se_negocio():
+    """
+    PRUEBA POSITIVA:
+    Con la compresión negociada, un payload por encima del umbral se envía
+    comprimido y con la bandera activada en el prefijo de tamaño.
+    """
+    # 1. Preparación
+    mock_socket = Mock()
+    datos_a_enviar = {"type": "message", "text": "log repetido " * 200}
+
+    # 2. Actuación
+    Protocolo.enviar(mock_socket, datos_a_enviar, compresion=True)
+
+    # 3. Aserción
+    trama = mock_socket.sendall.call_args[0][0]
+    cabecera = struct.unpack('!I', trama[:4])[0]
+    assert cabecera & Protocolo.BANDERA_COMPRIMIDO
+    assert len(trama) < len(json.dumps(datos_a_enviar))
+
+def test_enviar_no_comprime_por_debajo_del_umbral():
+    """
+    PRUEBA NEGATIVA:
+    Los mensajes pequeños se envían planos aunque la compresión esté negociada.
+    """
+    mock_socket = Mock()
+    datos_a_enviar = {"type": "message", "text": "hola"}
+
+    Protocolo.enviar(mock_socket, datos_a_enviar, compresion=True)
+
+    payload_esperado = json.dumps(datos_a_enviar).encode('utf-8')
+    mock_socket.sendall.assert_called_once_with(struct.pack('!I', len(payload_esperado)) + payload_esperado)
+
+def test_recibir_descomprime_tramas_comprimidas():
+    """
+    PRUEBA POSITIVA:
+    'recibir' detecta la bandera de compresión y devuelve el diccionario original.
+    """
+    mock_socket = Mock()
+    datos_originales = {"type": "message", "text": "x" * 2000}
+    trama = Protocolo.trama_comprimida(Protocolo.codificar(datos_originales))
+    mock_socket.recv.side_effect = [trama[:4], trama[4:]]
+
+    assert Protocolo.recibir(mock_socket) == datos_originales
+
+def test_recibir_rechaza_payloads_que_descomprimidos_superan_el_maximo():
+    """
+    PRUEBA NEGATIVA:
+    Una trama pequeña que al descomprimirse supera el máximo no se descomprime
+    entera: 'recibir' devuelve None.
+    """
+    mock_socket = Mock()
+    trama = Protocolo.trama_comprimida(b"0" * (Protocolo.MAXIMO_DESCOMPRIMIDO + 1))
+    assert len(trama) < 100 * 1024
+    mock_socket.recv.side_effect = [trama[:4], trama[4:]]
+
+    assert Protocolo.recibir(mock_socket) is None
+
+def test_recibir_rechaza_tramas_comprimidas_si_no_se_negocio():
+    """
+    PRUEBA NEGATIVA:
+    Sin compresión negociada, una trama comprimida se rechaza sin leer su payload.
+    """
+    mock_socket = Mock()
+    trama = Protocolo.trama_comprimida(Protocolo.codificar({"type": "message", "text": "x" * 2000}))
+    mock_socket.recv.side_effect = [trama[:4], trama[4:]]
+
+    assert Protocolo.recibir(mock_socket, compresion=False) is None
+    assert mock_socket.recv.call_count == 1
+
+def test_recibir_rechaza_tramas_mayores_que_el_maximo_sin_leerlas():
+    """
+    PRUEBA NEGATIVA:
+    Una trama que declara más de `MAXIMO_TRAMA` bytes se rechaza con solo leer
+    su prefijo, sin reservar memoria para el payload.
+    """
+    mock_socket = Mock()
+    mock_socket.recv.side_effect = [struct.pack('!I', Protocolo.MAXIMO_TRAMA + 1)]
+
+    assert Protocolo.recibir(mock_socket) is None
+    assert mock_socket.recv.call_count == 1
+
+def test_recibir_acepta_un_fragmento_de_transferencia_completo():
+    """
+    PRUEBA POSITIVA:
+    El máximo deja pasar el mayor fragmento que envía un cliente legítimo.
+    """
+    mock_socket = Mock()
+    fragmento = next(m for m in Protocolo.mensajes_transferencia(
+        "t1", "a.bin", io.BytesIO(b"\xff" * Protocolo.TAMAÑO_FRAGMENTO), Protocolo.TAMAÑO_FRAGMENTO)
+        if m["type"] == "transfer_chunk")
+    trama = Protocolo.trama(Protocolo.codificar(fragmento))
+    mock_socket.recv.side_effect = [trama[:4], trama[4:]]
+
+    assert Protocolo.recibir(mock_socket) == fragmento
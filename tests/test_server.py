@@ -1,5 +1,8 @@
 # tests/test_server.py
 
+import errno
+import socket
+import pytest
 from unittest.mock import Mock, patch
 import sys
 import os
@@ -70,4 +73,340 @@ def test_broadcast_no_retransmite_mensajes_demasiado_largos():
 
 		# 3. Assert: Verify the outcome
 		# The server should NOT have called the send method.
-		mock_enviar.assert_not_called()
\ No newline at end of file
+		mock_enviar.assert_not_called()
+
+def test_broadcast_comprime_una_vez_y_solo_para_quien_lo_negocio():
+	"""
+	Prueba que un mensaje grande se comprime una sola vez, que la trama comprimida
+	se comparte entre los clientes que negociaron la compresión y que el resto
+	recibe la trama plana.
+	"""
+	# 1. Arrange
+	servidor = Servidor()
+	emisor = Mock()
+	comprimido_a = Mock(compresion=True)
+	comprimido_b = Mock(compresion=True)
+	plano = Mock(compresion=False)
+	servidor.clientes = {emisor: "Emisor", "a": "A", "b": "B", "c": "C"}
+	servidor.conexiones = {emisor: Mock(compresion=True), "a": comprimido_a, "b": comprimido_b, "c": plano}
+
+	# Un texto válido (<= 512 caracteres) cuyo JSON supera el umbral de compresión.
+	mensaje = {"type": "message", "username": "Emisor", "text": "ñ" * 500}
+
+	# 2. Act
+	with patch('protocol.Protocolo.trama_comprimida', wraps=Protocolo.trama_comprimida) as mock_comprimir:
+		servidor.broadcast(mensaje, emisor)
+
+		# 3. Assert
+		mock_comprimir.assert_called_once()
+
+	servidor.conexiones[emisor].encolar.assert_not_called()
+	trama_a = comprimido_a.encolar.call_args[0][0]
+	assert trama_a is comprimido_b.encolar.call_args[0][0]
+	assert plano.encolar.call_args[0][0] == Protocolo.trama(Protocolo.codificar(dict(mensaje, seq=1)))
+	assert len(trama_a) < len(plano.encolar.call_args[0][0])
+	assert servidor.metricas.obtener("bytes_ahorrados_compresion") > 0
+
+
+def _iniciar_transferencia(servidor, emisor, id_transferencia="t1"):
+	servidor._gestionar_transferencia(emisor, "Emisor", {
+		"type": "transfer_start", "id": id_transferencia, "name": "log.txt", "size": 10
+	}, None)
+
+
+def test_fragmentos_se_reenvian_con_los_mismos_bytes():
+	"""
+	Prueba que cada fragmento se reenvía con el payload recibido, sin volver a
+	serializarlo, y solo a los clientes presentes al empezar la transferencia.
+	"""
+	# 1. Arrange
+	servidor = Servidor(compresion=False)
+	emisor, receptor = Mock(), Mock(compresion=False)
+	servidor.clientes = {emisor: "Emisor", "r": "Receptor"}
+	servidor.conexiones = {emisor: Mock(compresion=False), "r": receptor}
+	receptor.pendiente.return_value = 0
+	_iniciar_transferencia(servidor, emisor)
+
+	# Un cliente que llega a mitad de la transferencia no recibe fragmentos sueltos.
+	tardio = Mock(compresion=False)
+	servidor.conexiones["t"] = tardio
+
+	# 2. Act
+	fragmento = {"type": "transfer_chunk", "id": "t1", "data": "aG9sYQ=="}
+	payload = Protocolo.codificar(fragmento)
+	servidor._gestionar_transferencia(emisor, "Emisor", fragmento, payload)
+
+	# 3. Assert
+	assert receptor.encolar.call_args[0][:2] == (Protocolo.trama(payload), "t1")
+	tardio.encolar.assert_not_called()
+
+
+def test_destinatario_lento_es_cancelado():
+	"""
+	Prueba que, si un destinatario tiene la ventana llena, se le cancela la
+	transferencia en el acto en lugar de acumular sus fragmentos en memoria.
+	"""
+	# 1. Arrange
+	servidor = Servidor(compresion=False)
+	emisor, lento = Mock(), Mock(compresion=False)
+	servidor.clientes = {emisor: "Emisor", "l": "Lento"}
+	servidor.conexiones = {emisor: Mock(compresion=False), "l": lento}
+	lento.pendiente.return_value = servidor.ventana_transferencia
+	_iniciar_transferencia(servidor, emisor)
+	lento.encolar.reset_mock()
+
+	# 2. Act
+	fragmento = {"type": "transfer_chunk", "id": "t1", "data": "aG9sYQ=="}
+	servidor._gestionar_transferencia(emisor, "Emisor", fragmento, Protocolo.codificar(fragmento))
+
+	# 3. Assert
+	lento.descartar_transferencia.assert_called_once_with("t1")
+	trama = lento.encolar.call_args[0][0]
+	assert Protocolo.decodificar(trama[4:]) == {"type": "transfer_abort", "id": "t1"}
+	assert "l" not in servidor.transferencias["t1"]["destinatarios"]
+
+
+
+def _mensajes_encolados(conexion):
+	return [Protocolo.decodificar(c[0][0][4:]) for c in conexion.encolar.call_args_list]
+
+
+def test_destinatario_con_la_cola_llena_es_cancelado():
+	"""
+	Prueba que el límite de bytes pendientes por conexión cuenta todas sus
+	transferencias a la vez, no solo la del fragmento que llega.
+	"""
+	# 1. Arrange
+	servidor = Servidor(compresion=False, limite_cola=1024)
+	emisor, lento = Mock(), Mock(compresion=False)
+	servidor.clientes = {emisor: "Emisor", "l": "Lento"}
+	servidor.conexiones = {emisor: Mock(compresion=False), "l": lento}
+	lento.pendiente.side_effect = lambda transferencia=None: 1024 if transferencia is None else 0
+	_iniciar_transferencia(servidor, emisor)
+
+	# 2. Act
+	fragmento = {"type": "transfer_chunk", "id": "t1", "data": "aG9sYQ=="}
+	servidor._gestionar_transferencia(emisor, "Emisor", fragmento, Protocolo.codificar(fragmento))
+
+	# 3. Assert
+	lento.descartar_transferencia.assert_called_once_with("t1")
+	assert _mensajes_encolados(lento)[-1] == {"type": "transfer_abort", "id": "t1"}
+
+
+def test_emisor_no_abre_mas_transferencias_que_el_limite():
+	"""
+	Prueba que un cliente no puede tener más de `transferencias_por_emisor`
+	transferencias a la vez: las que sobran se rechazan sin difundirlas.
+	"""
+	# 1. Arrange
+	servidor = Servidor(compresion=False, transferencias_por_emisor=2)
+	emisor, receptor = Mock(), Mock(compresion=False)
+	servidor.clientes = {emisor: "Emisor", "r": "Receptor"}
+	servidor.conexiones = {emisor: Mock(compresion=False), "r": receptor}
+
+	# 2. Act
+	for id_transferencia in ("t1", "t2", "t3"):
+		_iniciar_transferencia(servidor, emisor, id_transferencia)
+
+	# 3. Assert
+	assert set(servidor.transferencias) == {"t1", "t2"}
+	assert _mensajes_encolados(servidor.conexiones[emisor])[-1] == {
+		"type": "transfer_abort", "id": "t3", "reason": "limit"
+	}
+	assert [m["id"] for m in _mensajes_encolados(receptor)] == ["t1", "t2"]
+
+
+def test_credito_vuelve_al_emisor_cuando_el_fragmento_sale_hacia_todos():
+	"""
+	Prueba que el emisor recibe su crédito inicial al empezar y que cada fragmento
+	se lo devuelve solo cuando ha salido hacia todos los destinatarios.
+	"""
+	# 1. Arrange
+	servidor = Servidor(compresion=False, credito_transferencia=1)
+	emisor, rapido, lento = Mock(), Mock(compresion=False), Mock(compresion=False)
+	conexion_emisor = Mock(compresion=False)
+	servidor.clientes = {emisor: "Emisor", "r": "Rapido", "l": "Lento"}
+	servidor.conexiones = {emisor: conexion_emisor, "r": rapido, "l": lento}
+	rapido.pendiente.return_value = lento.pendiente.return_value = 0
+	_iniciar_transferencia(servidor, emisor)
+	assert _mensajes_encolados(conexion_emisor) == [{"type": "transfer_credit", "id": "t1", "chunks": 1}]
+	fragmento = {"type": "transfer_chunk", "id": "t1", "data": "aG9sYQ=="}
+	servidor._gestionar_transferencia(emisor, "Emisor", fragmento, Protocolo.codificar(fragmento))
+
+	# 2. Act: el transfer_start y el fragmento salen hacia el rápido, pero no hacia el lento.
+	for _ in range(2):
+		servidor._trama_transferencia_enviada(rapido, "t1")
+	antes = len(conexion_emisor.encolar.call_args_list)
+	for _ in range(2):
+		servidor._trama_transferencia_enviada(lento, "t1")
+
+	# 3. Assert
+	assert antes == 1
+	assert _mensajes_encolados(conexion_emisor)[-1] == {"type": "transfer_credit", "id": "t1", "chunks": 1}
+	# Con crédito de nuevo, ya no corre el plazo para cancelar a los atrasados.
+	assert servidor.transferencias["t1"]["temporizador"] is None
+
+def test_broadcast_numera_los_mensajes_y_los_guarda_en_el_historial():
+	"""
+	Prueba que cada mensaje difundido recibe un número de secuencia creciente
+	y que el historial está acotado.
+	"""
+	# 1. Arrange
+	servidor = Servidor(tamaño_historial=2)
+	receptor = Mock(compresion=False)
+	servidor.clientes = {"r": "Receptor"}
+	servidor.conexiones = {"r": receptor}
+
+	# 2. Act
+	for texto in ("uno", "dos", "tres"):
+		servidor.broadcast({"type": "message", "username": "Emisor", "text": texto}, None)
+
+	# 3. Assert
+	secuencias = [Protocolo.decodificar(c[0][0][4:])["seq"] for c in receptor.encolar.call_args_list]
+	assert secuencias == [1, 2, 3]
+	assert [seq for seq, _, _ in servidor.historial] == [2, 3]
+
+
+
+def test_broadcast_tras_el_traspaso_devuelve_el_mensaje_al_emisor():
+	"""
+	Prueba que, una vez cedido el socket al proceso nuevo, un mensaje de chat no
+	se difunde ni se numera, sino que vuelve al emisor como 'rejected'.
+	"""
+	# 1. Arrange
+	servidor = Servidor()
+	servidor.cedido = True
+	emisor, receptor = Mock(compresion=False), Mock(compresion=False)
+	servidor.clientes = {"e": "Emisor", "r": "Receptor"}
+	servidor.conexiones = {"e": emisor, "r": receptor}
+
+	# 2. Act
+	servidor.broadcast({"type": "message", "username": "Emisor", "text": "hola"}, "e")
+
+	# 3. Assert
+	receptor.encolar.assert_not_called()
+	assert servidor.secuencia == 0
+	trama = emisor.encolar.call_args[0][0]
+	assert Protocolo.decodificar(trama[4:]) == {
+		"type": "rejected", "reason": "restart", "message": {"type": "message", "text": "hola"}
+	}
+
+def test_puerto_cero_expone_la_direccion_y_avisa_cuando_esta_listo():
+	"""
+	Prueba que con port=0 el servidor expone el puerto que eligió el sistema,
+	activa `listo` al escuchar y que `esperar_clientes` respeta el plazo.
+	"""
+	# 1. Arrange
+	servidor = Servidor('127.0.0.1', 0)
+	assert not servidor.listo.is_set()
+
+	# 2. Act
+	servidor.iniciar()
+
+	# 3. Assert
+	try:
+		assert servidor.listo.is_set()
+		assert servidor.direccion[1] != 0
+		assert servidor.esperar_clientes(0, timeout=0) is True
+		assert servidor.esperar_clientes(1, timeout=0.01) is False
+	finally:
+		servidor.detener()
+	assert not servidor.listo.is_set()
+
+
+def test_esperar_clientes_cuenta_al_cliente_cuando_su_join_ya_se_difundio():
+	"""
+	Prueba que un cliente no cuenta para `esperar_clientes` hasta que su 'join'
+	está difundido, para que lo que se envíe después llegue detrás.
+	"""
+	# 1. Arrange
+	servidor = Servidor()
+	registrados_al_difundir = []
+	difundir = servidor.broadcast
+
+	def broadcast(mensaje, socket_emisor):
+		if mensaje.get("type") == "join":
+			registrados_al_difundir.append(servidor.esperar_clientes(1, timeout=0))
+		difundir(mensaje, socket_emisor)
+
+	servidor.broadcast = broadcast
+	cliente = servidor.conectar_local()
+
+	# 2. Act
+	try:
+		Protocolo.recibir(cliente)
+		Protocolo.enviar(cliente, {"username": "Alice"})
+
+		# 3. Assert
+		assert servidor.esperar_clientes(1, timeout=5)
+		assert registrados_al_difundir == [False]
+	finally:
+		cliente.close()
+
+
+def test_no_borra_una_ruta_unix_que_no_es_un_socket(tmp_path):
+	"""
+	Prueba que si la ruta del socket Unix es un archivo normal (p. ej. una ruta
+	mal escrita), el servidor se niega a arrancar en lugar de borrarlo.
+	"""
+	# 1. Arrange
+	ruta = tmp_path / "notas.txt"
+	ruta.write_text("no me borres")
+	servidor = Servidor('127.0.0.1', 0, ruta_unix=str(ruta))
+
+	# 2. Act y 3. Assert
+	try:
+		with pytest.raises(FileExistsError):
+			servidor.iniciar()
+	finally:
+		servidor.socket_servidor.close()
+	assert ruta.read_text() == "no me borres"
+
+
+def test_no_roba_las_rutas_de_un_servidor_en_marcha(tmp_path):
+	"""
+	Prueba que un segundo servidor no borra el socket Unix ni el canal de traspaso
+	de uno que sigue escuchando, y que comprobarlo no provoca un traspaso.
+	"""
+	# 1. Arrange
+	ruta_unix, ruta_traspaso = str(tmp_path / "chat.sock"), str(tmp_path / "traspaso.sock")
+	primero = Servidor('127.0.0.1', 0, ruta_unix=ruta_unix, ruta_traspaso=ruta_traspaso)
+	primero.iniciar()
+
+	try:
+		# 2. Act y 3. Assert
+		for opciones in ({"ruta_unix": ruta_unix}, {"ruta_traspaso": ruta_traspaso}):
+			segundo = Servidor('127.0.0.1', 0, **opciones)
+			with pytest.raises(OSError) as error:
+				segundo.iniciar()
+			segundo.socket_servidor.close()
+			assert error.value.errno == errno.EADDRINUSE
+
+		assert not primero.cedido and primero.hilo_traspaso.is_alive()
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as cliente:
+			cliente.connect(ruta_unix)
+			assert Protocolo.recibir(cliente).get("type") == "username_request"
+	finally:
+		primero.detener()
+
+
+def test_reutiliza_el_socket_unix_que_dejo_una_ejecucion_anterior(tmp_path):
+	"""
+	Prueba que un socket Unix abandonado (nadie escucha en él) se borra y se reutiliza.
+	"""
+	# 1. Arrange
+	ruta = str(tmp_path / "chat.sock")
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as abandonado:
+		abandonado.bind(ruta)
+	servidor = Servidor('127.0.0.1', 0, ruta_unix=ruta)
+
+	# 2. Act
+	servidor.iniciar()
+
+	# 3. Assert
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as cliente:
+			cliente.connect(ruta)
+			assert Protocolo.recibir(cliente).get("type") == "username_request"
+	finally:
+		servidor.detener()